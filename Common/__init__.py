@@ -1,6 +1,24 @@
 import yaml
+import libversion
 from dataclasses import dataclass
 
+# Needed for cached downloads
+import os
+import json
+# Needed for the snapshot history and published responses
+import brotli
+import gzip
+import shutil
+import tempfile
+# Needed for the package version index
+import mmap
+import struct
+import sys
+import urllib.error
+import urllib.request
+# Needed for the database connections
+import sqlite3
+
 
 @dataclass
 class Rules:
@@ -58,6 +76,9 @@ class DistroPackage:
     file: str
     line: str
 
+    # Cached result of libversion.version_compare2(version, upstream_version)
+    upstream_compare: int | None = None
+
     def toJSON(self):
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
 
@@ -70,6 +91,17 @@ class DistroPackage:
     def is_upstream_rolling(self) -> bool:
         return "Rolling" in self.upstream_version
 
+    def compare_to_upstream(self) -> int:
+        if self.upstream_compare is None:
+            self.upstream_compare = libversion.version_compare2(self.version, self.upstream_version)
+        return self.upstream_compare
+
+    def is_out_of_date(self) -> bool:
+        return self.compare_to_upstream() < 0
+
+    def is_newer_than_upstream(self) -> bool:
+        return self.compare_to_upstream() > 0
+
 
 @dataclass
 class UpstreamRequest:
@@ -87,6 +119,29 @@ class ForeignRepositoryChangeReport:
         self.packages = []
 
 
+# Repository type -> ForeignRepository subclass
+foreign_repository_types: {str: type} = {}
+
+
+# Class decorator making a ForeignRepository subclass available to create_foreign_repository()
+def register_foreign_repository(type_name: str):
+    def register(cls):
+        foreign_repository_types[type_name] = cls
+        return cls
+
+    return register
+
+
+# Create a foreign repository from its configuration entry.
+# The "type" entry selects the registered class, all other entries are passed to its constructor.
+def create_foreign_repository(config: dict) -> "ForeignRepository":
+    arguments = dict(config)
+    type_name = arguments.pop("type", None)
+    if type_name not in foreign_repository_types:
+        raise ValueError("Unknown foreign repository type '{}'".format(type_name))
+    return foreign_repository_types[type_name](**arguments)
+
+
 @dataclass
 class ForeignRepository:
     canonical_repo_name: str = ""
@@ -109,24 +164,822 @@ class ForeignRepository:
     def get_change_report(self):
         return self.change_report
 
+    # Download and prepare the repository data. May run in a worker process, so it must not touch the database.
+    # Returns True if the data has changed since the last run.
+    def fetch(self) -> bool:
+        return False
+
+    # Called in the main process after fetch(), with its result.
+    # Must only read from the database, the changes are written by save_changes(), along with the check that is based
+    # on them.
+    def update_database(self, c, changed: bool):
+        pass
+
+    # Write the changes found by update_database(), in the transaction that saves the check
+    def save_changes(self, c):
+        pass
+
+    # Called once the changes of save_changes() have been committed
+    def finish_update(self):
+        pass
+
     def get_local_package_version(self, name: str) -> str | None:
         return None
 
-    def get_package_version(self, name: str) -> str | None:
+    # Name of the record in this repository that get_local_package_version() would answer from
+    def get_local_package_record(self, name: str) -> str | None:
+        return name if self.get_local_package_version(name) is not None else None
+
+    # Apply the rules of this repository to a package name, returns None if the package is ignored
+    def translate_package_name(self, name: str) -> str | None:
         if self.rules is not None and name in self.rules:
             # Parse rule
             if "action" in self.rules[name]:
                 action = self.rules[name]["action"]
                 if action == "alias":
                     if "alias" in self.rules[name]:
-                        return self.get_local_package_version(self.rules[name]["alias"])
+                        return self.rules[name]["alias"]
                     else:
-                        raise self.InvalidRuleException
+                        raise Rules.InvalidRuleException
                 elif action == "ignore":
                     return None
-            raise self.InvalidRuleException
+            raise Rules.InvalidRuleException
         else:
-            return self.get_local_package_version(name)
+            return name
+
+    def get_package_version(self, name: str) -> str | None:
+        local_name = self.translate_package_name(name)
+        if local_name is None:
+            return None
+        return self.get_local_package_version(local_name)
+
+    def get_package_record(self, name: str) -> str | None:
+        local_name = self.translate_package_name(name)
+        if local_name is None:
+            return None
+        return self.get_local_package_record(local_name)
 
     def get_repo_name(self) -> str:
-        return ""
\ No newline at end of file
+        return ""
+
+
+# Download a file, but only if the copy on disk is out of date.
+# The ETag / Last-Modified headers of the last download are stored next to the file, and are sent back to the
+# server as a conditional request. Interrupted downloads are kept as "<file>.part" and resumed with a range request.
+# Returns True if the file has been (re-)downloaded, and False if the server told us our copy is still current.
+# The validators of a new download are only used once commit_download_cache() has been called, so that the file is
+# downloaded again if processing it does not finish.
+def download_file_cached(url: str, file: str, chunk_size: int = 1024 * 1024) -> bool:
+    cache_file = file + ".http-cache.json"
+    partial_file = file + ".part"
+
+    cache_info: dict = {}
+    try:
+        with open(cache_file, "r") as f:
+            cache_info = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+    request = urllib.request.Request(url)
+    # Only do a conditional request if we actually have the file the validators belong to
+    if os.path.exists(file):
+        if "etag" in cache_info:
+            request.add_header("If-None-Match", cache_info["etag"])
+        if "last_modified" in cache_info:
+            request.add_header("If-Modified-Since", cache_info["last_modified"])
+    # Resume a previous download if we know which version of the file the partial data belongs to
+    partial_size = 0
+    if os.path.exists(partial_file) and "partial_etag" in cache_info:
+        partial_size = os.path.getsize(partial_file)
+        request.add_header("Range", "bytes={}-".format(partial_size))
+        request.add_header("If-Range", cache_info["partial_etag"])
+
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            print("'{}' is up to date".format(file))
+            return False
+        if e.code == 416 and partial_size:
+            # The partial file does not fit the remote file anymore, start over
+            os.remove(partial_file)
+            cache_info.pop("partial_etag", None)
+            with open(cache_file, "w") as f:
+                json.dump(cache_info, f)
+            return download_file_cached(url, file, chunk_size)
+        raise
+
+    with response:
+        # file:// URLs do not have a status
+        status = getattr(response, "status", None) or 200
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+
+        # Remember which version the partial file belongs to, so that an interrupted download can be resumed
+        cache_info.pop("partial_etag", None)
+        if etag is not None:
+            cache_info["partial_etag"] = etag
+        with open(cache_file, "w") as f:
+            json.dump(cache_info, f)
+
+        if status == 206:
+            print("Resuming download of '{}' at {} bytes".format(file, partial_size))
+        with open(partial_file, "ab" if status == 206 else "wb") as f:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+    # The old validators do not belong to the new file anymore
+    with open(cache_file, "w") as f:
+        json.dump(dict(), f)
+    os.replace(partial_file, file)
+    cache_info = dict()
+    if etag is not None:
+        cache_info["etag"] = etag
+    if last_modified is not None:
+        cache_info["last_modified"] = last_modified
+    with open(cache_file + ".pending", "w") as f:
+        json.dump(cache_info, f)
+    return True
+
+
+# Start using the validators of the last download of the file for conditional requests
+def commit_download_cache(file: str):
+    try:
+        os.replace(file + ".http-cache.json.pending", file + ".http-cache.json")
+    except FileNotFoundError:
+        pass
+
+
+# Incremental reader for large JSON documents.
+# Takes an iterable of text chunks, and only keeps the part of the document that has not been consumed yet in memory.
+class JSONStreamReader:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def __read_more(self) -> bool:
+        if self.eof:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return False
+        # Drop everything that has already been consumed
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    # Returns the next non-whitespace character without consuming it, or "" at the end of the document
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.__read_more():
+                return ""
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError("Expected '{}' in JSON stream, got '{}'".format(char, found))
+        self.pos += 1
+
+    # Decodes the next complete JSON value
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer might continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.__read_more()
+
+    # Iterates over the keys of the next JSON object.
+    # The caller has to consume the value belonging to each key (with value() or object_keys()) before continuing.
+    def object_keys(self):
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError("Expected a string key in JSON stream, got '{}'".format(key))
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("}")
+                return
+
+
+# Iterates over the (name, value) entries of the object stored as `key` in a top-level JSON object,
+# without having to load the whole document.
+def iterate_json_object_entries(chunks, key: str):
+    reader = JSONStreamReader(chunks)
+    for name in reader.object_keys():
+        if name != key:
+            reader.value()
+            continue
+        for entry in reader.object_keys():
+            yield entry, reader.value()
+
+
+# Compact, memory-mapped name -> version index of a foreign repository.
+# Built once when a repository is imported, and persisted to disk so that later runs can just map it again.
+#
+# File layout (all integers little endian u32, offsets relative to the start of the string blob):
+#   magic, name count, pname count
+#   name table, sorted by name:   name offset, name length, version offset, version length
+#   pname table, sorted by pname: pname offset, pname length, index into name table
+#   string blob, UTF-8, every distinct string is only stored once
+class PackageVersionIndex:
+    MAGIC = b"XBPVIDX1"
+    HEADER = struct.Struct("<8sII")
+    NAME_ENTRY = struct.Struct("<IIII")
+    PNAME_ENTRY = struct.Struct("<III")
+
+    def __init__(self, file: str):
+        self.file = file
+        with open(file, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < self.HEADER.size:
+            raise ValueError("Package index '{}' is truncated".format(file))
+        magic, self.name_count, self.pname_count = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            raise ValueError("'{}' is not a package index".format(file))
+        self.name_table = self.HEADER.size
+        self.pname_table = self.name_table + self.name_count * self.NAME_ENTRY.size
+        self.blob = self.pname_table + self.pname_count * self.PNAME_ENTRY.size
+        if len(self.map) < self.blob:
+            raise ValueError("Package index '{}' is truncated".format(file))
+
+    # Build an index from (name, pname, version) tuples and write it to `file`.
+    # If several names share a pname, the last one wins.
+    @staticmethod
+    def build(file: str, entries) -> "PackageVersionIndex":
+        versions: {str: str} = {}
+        pnames: {str: str} = {}
+        for name, pname, version in entries:
+            name = sys.intern(name)
+            versions[name] = sys.intern(version)
+            if pname is not None:
+                pnames[sys.intern(pname)] = name
+
+        blob = bytearray()
+        blob_offsets: {str: (int, int)} = {}
+
+        def add_string(string: str) -> (int, int):
+            if string not in blob_offsets:
+                encoded = string.encode()
+                blob_offsets[string] = (len(blob), len(encoded))
+                blob.extend(encoded)
+            return blob_offsets[string]
+
+        names = sorted(versions, key=lambda n: n.encode())
+        name_positions = {name: i for i, name in enumerate(names)}
+        name_table = bytearray()
+        for name in names:
+            name_table.extend(PackageVersionIndex.NAME_ENTRY.pack(*add_string(name), *add_string(versions[name])))
+        pname_table = bytearray()
+        for pname in sorted(pnames, key=lambda n: n.encode()):
+            pname_table.extend(PackageVersionIndex.PNAME_ENTRY.pack(*add_string(pname), name_positions[pnames[pname]]))
+
+        with open(file + ".tmp", "wb") as f:
+            f.write(PackageVersionIndex.HEADER.pack(PackageVersionIndex.MAGIC, len(names), len(pnames)))
+            f.write(name_table)
+            f.write(pname_table)
+            f.write(blob)
+        os.replace(file + ".tmp", file)
+        return PackageVersionIndex(file)
+
+    def __len__(self) -> int:
+        return self.name_count
+
+    def __string(self, offset: int, length: int) -> bytes:
+        return self.map[self.blob + offset:self.blob + offset + length]
+
+    def __find(self, table: int, entry_size: int, count: int, key: bytes) -> int | None:
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            candidate = self.__string(*struct.unpack_from("<II", self.map, table + middle * entry_size))
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def __entry(self, position: int) -> (str, str):
+        name_offset, name_length, version_offset, version_length = \
+            self.NAME_ENTRY.unpack_from(self.map, self.name_table + position * self.NAME_ENTRY.size)
+        return self.__string(name_offset, name_length).decode(), self.__string(version_offset, version_length).decode()
+
+    # Version of the package with exactly this name
+    def get_version(self, name: str) -> str | None:
+        position = self.__find(self.name_table, self.NAME_ENTRY.size, self.name_count, name.encode())
+        if position is None:
+            return None
+        return self.__entry(position)[1]
+
+    # Name of the package that provides this pname
+    def get_pname_package(self, pname: str) -> str | None:
+        position = self.__find(self.pname_table, self.PNAME_ENTRY.size, self.pname_count, pname.encode())
+        if position is None:
+            return None
+        name_position = self.PNAME_ENTRY.unpack_from(self.map, self.pname_table + position * self.PNAME_ENTRY.size)[2]
+        return self.__entry(name_position)[0]
+
+    # Name of the package that lookup() would return the version of
+    def resolve_name(self, name: str) -> str | None:
+        if self.__find(self.name_table, self.NAME_ENTRY.size, self.name_count, name.encode()) is not None:
+            return name
+        return self.get_pname_package(name)
+
+    # Look up a package by name, falling back to its pname
+    def lookup(self, name: str) -> str | None:
+        version = self.get_version(name)
+        if version is None:
+            pname_package = self.get_pname_package(name)
+            if pname_package is not None:
+                version = self.get_version(pname_package)
+        return version
+
+    # Iterates over all (name, version) pairs, sorted by name
+    def items(self):
+        for position in range(self.name_count):
+            yield self.__entry(position)
+
+    def close(self):
+        self.map.close()
+
+
+### Database connections
+# packages.db is written by both main.py and the web server, so it is used in WAL mode, in which readers are not
+# blocked by a writer (e.g. a check being saved). Writers wait up to `busy_timeout` seconds for each other.
+def connect_packages_database(file: str = "packages.db", busy_timeout: float = 30) -> sqlite3.Connection:
+    connection = sqlite3.connect(file, timeout=busy_timeout)
+    # WAL mode is stored in the database file, so this only changes anything the first time
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+
+# Open a database read only, e.g. xbdistro.db in the web server
+def connect_read_only_database(file: str, busy_timeout: float = 30) -> sqlite3.Connection:
+    return sqlite3.connect("file:{}?mode=ro".format(urllib.request.pathname2url(file)), uri=True,
+                           timeout=busy_timeout)
+
+
+# Indexes for the lookups the web server does on xbdistro.db, which XBStrapSQLite does not create itself
+def create_xbdistro_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS package_dependencies_package_name ON package_dependencies(package_name)")
+    c.execute("CREATE INDEX IF NOT EXISTS package_dependencies_package_depend ON package_dependencies(package_depend)")
+    c.execute("CREATE INDEX IF NOT EXISTS file_lines_package_name ON file_lines(package_name)")
+    c.execute("CREATE INDEX IF NOT EXISTS packages_name ON packages(name)")
+    c.execute("CREATE INDEX IF NOT EXISTS sources_source_name ON sources(source_name)")
+
+
+### Snapshot storage
+# Every check is stored as a snapshot. The latest snapshot is kept with one row per package in snapshot_packages,
+# so that it can be queried directly.
+# The history of all snapshots is kept in snapshot_history, as brotli compressed JSON: every few snapshots a keyframe
+# holding all packages, and in between deltas holding only the packages that changed since the snapshot before.
+# Shared between main.py (which writes them) and wsgi.py (which reads them).
+SNAPSHOT_PACKAGE_COLUMNS = ["package", "version", "upstream_version", "upstream_repo", "found_upstream", "file", "line",
+                            "upstream_compare"]
+# Packages shown as out of date. Must match the partial index, so that it is used.
+SNAPSHOT_OUT_OF_DATE_CONDITION = "found_upstream = 1 AND upstream_compare < 0"
+# Columns the package list can be sorted by
+SNAPSHOT_SORT_COLUMNS = dict(name="package", repo="upstream_repo", file="file")
+
+
+def create_snapshot_tables(c):
+    c.execute("CREATE TABLE IF NOT EXISTS snapshots(unix_timestamp INT PRIMARY KEY, amount INT)")
+    c.execute("CREATE TABLE IF NOT EXISTS snapshot_packages(unix_timestamp INT, position INT, package CHAR, "
+              "version CHAR, upstream_version CHAR, upstream_repo CHAR, found_upstream INT, file CHAR, line CHAR, "
+              "upstream_compare INT, PRIMARY KEY(unix_timestamp, package)) WITHOUT ROWID")
+    c.execute("CREATE INDEX IF NOT EXISTS snapshot_packages_package ON snapshot_packages(package, unix_timestamp)")
+    # Used to filter the package list of the latest snapshot
+    c.execute("CREATE INDEX IF NOT EXISTS snapshot_packages_upstream_repo "
+              "ON snapshot_packages(unix_timestamp, upstream_repo)")
+    c.execute("CREATE INDEX IF NOT EXISTS snapshot_packages_out_of_date ON snapshot_packages(unix_timestamp, package) "
+              "WHERE {}".format(SNAPSHOT_OUT_OF_DATE_CONDITION))
+    c.execute("CREATE TABLE IF NOT EXISTS snapshot_history(unix_timestamp INT PRIMARY KEY, keyframe INT, data BLOB)")
+    c.execute("CREATE TABLE IF NOT EXISTS package_history(package CHAR, unix_timestamp INT, version CHAR, "
+              "upstream_version CHAR, upstream_repo CHAR, found_upstream INT, upstream_compare INT, "
+              "PRIMARY KEY(package, unix_timestamp)) WITHOUT ROWID")
+
+
+def _snapshot_package_from_row(row) -> DistroPackage:
+    return DistroPackage(package=row[0],
+                         version=row[1],
+                         upstream_version=row[2],
+                         upstream_repo=row[3],
+                         found_upstream=bool(row[4]),
+                         file=row[5],
+                         line=row[6],
+                         upstream_compare=row[7])
+
+
+def _snapshot_package_to_row(package: DistroPackage) -> list:
+    return [package.package, package.version, package.upstream_version, package.upstream_repo,
+            package.found_upstream, package.file, str(package.line), package.compare_to_upstream()]
+
+
+# If a name shows up twice, only the first one is kept, like DistroPackageStatus.getPackage() does
+def _unique_snapshot_rows(packages: [DistroPackage]) -> [list]:
+    rows: {str: list} = {}
+    for package in packages:
+        if package.package not in rows:
+            rows[package.package] = _snapshot_package_to_row(package)
+    return list(rows.values())
+
+
+def _encode_history(data) -> bytes:
+    return brotli.compress(json.dumps(data, separators=(",", ":")).encode(), quality=9)
+
+
+def _decode_history(data: bytes):
+    return json.loads(brotli.decompress(data))
+
+
+# Write the history entry of a snapshot, as a delta against `previous` if given, otherwise as a keyframe
+def _save_snapshot_history(c, timestamp: int, packages: [DistroPackage],
+                           previous: list[DistroPackage] | None):
+    rows = _unique_snapshot_rows(packages)
+    if previous is None:
+        c.execute("INSERT OR REPLACE INTO snapshot_history(unix_timestamp, keyframe, data) VALUES(?, 1, ?)",
+                  [timestamp, _encode_history(rows)])
+        return
+    previous_rows: {str: list} = {row[0]: row for row in _unique_snapshot_rows(previous)}
+    current_names = set(row[0] for row in rows)
+    delta = dict(changed=[row for row in rows if previous_rows.get(row[0]) != row],
+                 removed=[name for name in previous_rows if name not in current_names])
+    c.execute("INSERT OR REPLACE INTO snapshot_history(unix_timestamp, keyframe, data) VALUES(?, 0, ?)",
+              [timestamp, _encode_history(delta)])
+
+
+# Number of deltas between the last keyframe before `timestamp` and `timestamp`, or None if there is no keyframe
+def _count_deltas_since_keyframe(c, timestamp: int) -> int | None:
+    c.execute("SELECT MAX(unix_timestamp) FROM snapshot_history WHERE keyframe = 1 AND unix_timestamp < ?",
+              [timestamp])
+    keyframe_timestamp = c.fetchone()[0]
+    if keyframe_timestamp is None:
+        return None
+    c.execute("SELECT COUNT(*) FROM snapshot_history WHERE unix_timestamp > ? AND unix_timestamp < ?",
+              [keyframe_timestamp, timestamp])
+    return c.fetchone()[0]
+
+
+# Save a snapshot, and drop the package rows of the snapshots before it (they remain available from the history).
+# A keyframe is written if there have been `keyframe_interval` deltas since the last one.
+def save_snapshot(c, timestamp: int, packages: [DistroPackage], keyframe_interval: int = 30):
+    previous_timestamp = get_latest_snapshot_timestamp(c)
+    previous: list[DistroPackage] | None = None
+    if previous_timestamp is not None:
+        previous = load_snapshot(c, previous_timestamp)
+    deltas = _count_deltas_since_keyframe(c, timestamp)
+
+    c.execute("INSERT INTO snapshots(unix_timestamp, amount) VALUES(?, ?)", [timestamp, len(packages)])
+    # If a name shows up twice, only the first one is kept, like DistroPackageStatus.getPackage() does
+    c.executemany("INSERT OR IGNORE INTO snapshot_packages(unix_timestamp, position, {}) VALUES(?, ?, {})"
+                  .format(", ".join(SNAPSHOT_PACKAGE_COLUMNS), ", ".join("?" * len(SNAPSHOT_PACKAGE_COLUMNS))),
+                  [(timestamp, position, *_snapshot_package_to_row(package))
+                   for position, package in enumerate(packages)])
+    _save_snapshot_history(c, timestamp, packages,
+                           previous if deltas is not None and deltas + 1 < keyframe_interval else None)
+    _save_package_history(c, timestamp, packages, previous)
+    c.execute("DELETE FROM snapshot_packages WHERE unix_timestamp < ?", [timestamp])
+    # Without statistics, the query planner does not know that the filtering indexes are more selective than the
+    # primary key, and ignores them
+    c.execute("ANALYZE snapshot_packages")
+
+
+### Package history
+# For every package, package_history holds a row for every check in which its state changed (including when it was
+# added), and a row with a NULL version when it was removed. This way, the history of a single package can be read
+# with an index seek, without decoding any snapshots.
+PACKAGE_HISTORY_COLUMNS = ["version", "upstream_version", "upstream_repo", "found_upstream", "upstream_compare"]
+
+
+def _package_history_state(package: DistroPackage) -> tuple:
+    return (package.version, package.upstream_version, package.upstream_repo, bool(package.found_upstream),
+            package.compare_to_upstream())
+
+
+def _save_package_history(c, timestamp: int, packages: [DistroPackage], previous: list[DistroPackage] | None):
+    previous_states: {str: tuple} = {}
+    for package in previous if previous is not None else []:
+        previous_states.setdefault(package.package, _package_history_state(package))
+    states: {str: tuple} = {}
+    for package in packages:
+        states.setdefault(package.package, _package_history_state(package))
+
+    rows = [(name, timestamp, *state) for name, state in states.items() if previous_states.get(name) != state]
+    rows += [(name, timestamp, *([None] * len(PACKAGE_HISTORY_COLUMNS)))
+             for name in previous_states if name not in states]
+    c.executemany("INSERT OR REPLACE INTO package_history(package, unix_timestamp, {}) VALUES(?, ?, {})"
+                  .format(", ".join(PACKAGE_HISTORY_COLUMNS), ", ".join("?" * len(PACKAGE_HISTORY_COLUMNS))), rows)
+
+
+# Fill package_history from the snapshot history, if it has not been filled yet
+def migrate_package_history(c):
+    c.execute("SELECT 1 FROM package_history LIMIT 1")
+    if c.fetchone() is not None:
+        return
+    c.execute("SELECT unix_timestamp FROM snapshot_history ORDER BY unix_timestamp")
+    timestamps = [row[0] for row in c.fetchall()]
+    if not len(timestamps):
+        return
+    print("Building the package history of {} snapshots".format(len(timestamps)))
+    previous: list[DistroPackage] | None = None
+    for timestamp in timestamps:
+        packages = reconstruct_snapshot(c, timestamp)
+        _save_package_history(c, timestamp, packages, previous)
+        previous = packages
+
+
+# All recorded states of a package, oldest first
+def load_package_history(c, name: str) -> [dict]:
+    c.execute("SELECT unix_timestamp, {} FROM package_history WHERE package = ? ORDER BY unix_timestamp"
+              .format(", ".join(PACKAGE_HISTORY_COLUMNS)), [name])
+    history: [dict] = []
+    for row in c.fetchall():
+        entry = dict(unix_timestamp=row[0], removed=row[1] is None)
+        if row[1] is not None:
+            entry.update(version=row[1],
+                         upstream_version=row[2],
+                         upstream_repo=row[3],
+                         found_upstream=bool(row[4]),
+                         is_up_to_date=row[5] >= 0)
+        history.append(entry)
+    return history
+
+
+# Periods in which a package was out of date, from a history returned by load_package_history().
+# A period that has not ended yet has an "until" of None, its duration is counted up to `latest_timestamp`.
+def get_out_of_date_periods(history: [dict], latest_timestamp: int) -> [dict]:
+    periods: [dict] = []
+    since: int | None = None
+    for entry in history:
+        out_of_date = not entry["removed"] and entry["found_upstream"] and not entry["is_up_to_date"]
+        if out_of_date and since is None:
+            since = entry["unix_timestamp"]
+        elif not out_of_date and since is not None:
+            periods.append(dict(since=since, until=entry["unix_timestamp"], duration=entry["unix_timestamp"] - since))
+            since = None
+    if since is not None:
+        periods.append(dict(since=since, until=None, duration=latest_timestamp - since))
+    return periods
+
+
+# Create the history entries of snapshots that have none yet (e.g. ones written before the history existed), and
+# drop the package rows of all but the latest snapshot
+def migrate_snapshot_history(c, keyframe_interval: int = 30):
+    c.execute("SELECT unix_timestamp FROM snapshots WHERE unix_timestamp NOT IN "
+              "(SELECT unix_timestamp FROM snapshot_history) ORDER BY unix_timestamp")
+    missing = [row[0] for row in c.fetchall()]
+    if not len(missing):
+        return
+    print("Encoding the history of {} snapshots".format(len(missing)))
+    for timestamp in missing:
+        c.execute("SELECT MAX(unix_timestamp) FROM snapshot_history WHERE unix_timestamp < ?", [timestamp])
+        previous_timestamp = c.fetchone()[0]
+        deltas = _count_deltas_since_keyframe(c, timestamp)
+        previous: list[DistroPackage] | None = None
+        if previous_timestamp is not None and deltas is not None and deltas + 1 < keyframe_interval:
+            previous = load_snapshot(c, previous_timestamp)
+        _save_snapshot_history(c, timestamp, load_snapshot(c, timestamp), previous)
+    c.execute("DELETE FROM snapshot_packages WHERE unix_timestamp < (SELECT MAX(unix_timestamp) FROM snapshots)")
+
+
+def get_latest_snapshot_timestamp(c) -> int | None:
+    c.execute("SELECT MAX(unix_timestamp) FROM snapshots")
+    return c.fetchone()[0]
+
+
+# Rebuild a snapshot from its history, starting at the last keyframe before it
+def reconstruct_snapshot(c, timestamp: int) -> [DistroPackage]:
+    c.execute("SELECT keyframe, data FROM snapshot_history WHERE unix_timestamp <= ? AND unix_timestamp >= "
+              "(SELECT MAX(unix_timestamp) FROM snapshot_history WHERE keyframe = 1 AND unix_timestamp <= ?) "
+              "ORDER BY unix_timestamp", [timestamp, timestamp])
+    rows: {str: list} = {}
+    for keyframe, data in c.fetchall():
+        data = _decode_history(data)
+        if keyframe:
+            rows = {}
+            for row in data:
+                rows.setdefault(row[0], row)
+            continue
+        for name in data["removed"]:
+            rows.pop(name, None)
+        # Entries written by older versions may still contain a name twice
+        changed: {str: list} = {}
+        for row in data["changed"]:
+            changed.setdefault(row[0], row)
+        rows.update(changed)
+    return [_snapshot_package_from_row(row) for row in rows.values()]
+
+
+def load_snapshot(c, timestamp: int) -> [DistroPackage]:
+    c.execute("SELECT {} FROM snapshot_packages WHERE unix_timestamp = ? ORDER BY position"
+              .format(", ".join(SNAPSHOT_PACKAGE_COLUMNS)), [timestamp])
+    rows = c.fetchall()
+    if not len(rows):
+        # Only the latest snapshot is stored as rows
+        return reconstruct_snapshot(c, timestamp)
+    return [_snapshot_package_from_row(row) for row in rows]
+
+
+def load_snapshot_package(c, timestamp: int, name: str) -> DistroPackage | None:
+    c.execute("SELECT {} FROM snapshot_packages WHERE unix_timestamp = ? AND package = ?"
+              .format(", ".join(SNAPSHOT_PACKAGE_COLUMNS)), [timestamp, name])
+    row = c.fetchone()
+    if row is None:
+        c.execute("SELECT 1 FROM snapshot_packages WHERE unix_timestamp = ? LIMIT 1", [timestamp])
+        if c.fetchone() is None:
+            for package in reconstruct_snapshot(c, timestamp):
+                if package.package == name:
+                    return package
+        return None
+    return _snapshot_package_from_row(row)
+
+
+# Query the packages of a snapshot with filters, sorting and keyset pagination. Only works for the latest snapshot,
+# as it is the only one stored as rows.
+# `after` is the (sort value, package name) of the last package of the previous page.
+def query_snapshot_packages(c, timestamp: int, out_of_date: bool | None = None, repo: str | None = None,
+                            names: list[str] | None = None, prefix: str | None = None, sort: str = "name",
+                            descending: bool = False, after: list | None = None,
+                            limit: int | None = None) -> [DistroPackage]:
+    # Missing values are sorted as empty strings, so that they can be compared against the cursor
+    sort_column = SNAPSHOT_SORT_COLUMNS[sort]
+    if sort_column != "package":
+        sort_column = "COALESCE({}, '')".format(sort_column)
+    conditions: [str] = ["unix_timestamp = ?"]
+    parameters: list = [timestamp]
+    if out_of_date is not None:
+        conditions.append(SNAPSHOT_OUT_OF_DATE_CONDITION if out_of_date
+                          else "NOT ({})".format(SNAPSHOT_OUT_OF_DATE_CONDITION))
+    if repo is not None:
+        conditions.append("upstream_repo = ?")
+        parameters.append(repo)
+    if names is not None:
+        conditions.append("package IN (SELECT value FROM json_each(?))")
+        parameters.append(json.dumps(names))
+    if prefix is not None and len(prefix):
+        # A range instead of LIKE, so that the primary key can be used
+        conditions.append("package >= ? AND package < ?")
+        parameters += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+    if after is not None:
+        conditions.append("({}, package) {} (?, ?)".format(sort_column, "<" if descending else ">"))
+        parameters += after
+
+    order = "DESC" if descending else "ASC"
+    query = "SELECT {} FROM snapshot_packages WHERE {} ORDER BY {} {}, package {}".format(
+        ", ".join(SNAPSHOT_PACKAGE_COLUMNS), " AND ".join(conditions), sort_column, order, order)
+    if limit is not None:
+        query += " LIMIT ?"
+        parameters.append(limit)
+    c.execute(query, parameters)
+    return [_snapshot_package_from_row(row) for row in c.fetchall()]
+
+
+# Drop all snapshots before `keep_since` (the first remaining one is turned into a keyframe), and re-encode the
+# remaining history so that there is a keyframe every `keyframe_interval` snapshots.
+# The latest snapshot is always kept, even if it is older than `keep_since`.
+def compact_snapshot_history(c, keep_since: int | None, keyframe_interval: int = 30):
+    latest_timestamp = get_latest_snapshot_timestamp(c)
+    if latest_timestamp is None:
+        return
+    if keep_since is not None and keep_since > latest_timestamp:
+        print("No snapshots since {}, keeping the latest one".format(keep_since))
+        keep_since = latest_timestamp
+    c.execute("SELECT unix_timestamp FROM snapshot_history WHERE unix_timestamp >= ? ORDER BY unix_timestamp",
+              [keep_since if keep_since is not None else 0])
+    kept = [row[0] for row in c.fetchall()]
+
+    # Rewriting an entry does not change the snapshot it decodes to, so the entries can be rewritten in order while
+    # reconstructing the snapshots from them
+    previous: list[DistroPackage] | None = None
+    for index, timestamp in enumerate(kept):
+        packages = reconstruct_snapshot(c, timestamp)
+        _save_snapshot_history(c, timestamp, packages, previous if index % keyframe_interval else None)
+        previous = packages
+    if keep_since is not None:
+        print("Dropping snapshots before {}".format(keep_since))
+        # The package history has to start with the full state of the first remaining snapshot
+        if len(kept):
+            _save_package_history(c, kept[0], reconstruct_snapshot(c, kept[0]), None)
+        c.execute("DELETE FROM package_history WHERE unix_timestamp < ?", [keep_since])
+        c.execute("DELETE FROM snapshot_history WHERE unix_timestamp < ?", [keep_since])
+        c.execute("DELETE FROM snapshots WHERE unix_timestamp < ?", [keep_since])
+        c.execute("DELETE FROM snapshot_packages WHERE unix_timestamp < ?", [keep_since])
+        c.execute("DELETE FROM check_metadata WHERE unix_timestamp < ?", [keep_since])
+        c.execute("DELETE FROM check_state WHERE unix_timestamp < ?", [keep_since])
+    print("Compacted history to {} snapshots".format(len(kept)))
+
+
+### Published responses
+# main.py publishes prebuilt responses for every check into <published_dir>/<unix_timestamp>/, which wsgi.py serves
+# directly. Every file is stored as is, and precompressed with brotli and gzip.
+# Content-Encoding -> file suffix, in order of preference
+PUBLISHED_ENCODINGS = {"br": ".br", "gzip": ".gz"}
+
+
+# Package as returned by the API and used by the templates
+def package_to_dict(package: DistroPackage) -> dict:
+    package_dict: dict = dict(name=package.package,
+                              version=package.version,
+                              origin=dict(file=package.file, line=package.line))
+    if package.found_upstream:
+        package_dict["upstream_version"] = package.upstream_version
+        package_dict["upstream_repo"] = package.upstream_repo
+        # Check if package is up to date, this is stored along with the check
+        package_dict["is_up_to_date"] = not package.is_out_of_date()
+    return package_dict
+
+
+def get_published_path(published_dir: str, timestamp: int, filename: str) -> str:
+    return os.path.join(published_dir, str(timestamp), filename)
+
+
+# Files may be written by several processes at once, so write them under a unique name first
+def write_file_atomically(path: str, data: bytes):
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".", delete=False) as file:
+        file.write(data)
+    os.replace(file.name, path)
+
+
+def write_published_file(published_dir: str, timestamp: int, filename: str, data: bytes):
+    path = get_published_path(published_dir, timestamp, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # The uncompressed file is written last, so that once it exists, all variants do
+    variants = [(suffix, brotli.compress(data) if encoding == "br" else gzip.compress(data))
+                for encoding, suffix in PUBLISHED_ENCODINGS.items()]
+    variants.append(("", data))
+    for suffix, content in variants:
+        write_file_atomically(path + suffix, content)
+
+
+# Publish the package list API response, and the data needed to render the main page.
+# `report_formats` are the formats the report of the check has been stored in, which the main page links to.
+def publish_package_list(published_dir: str, timestamp: int, packages: [DistroPackage], count_out_of_date: int,
+                         report_formats: [str]):
+    package_list = [package_to_dict(package) for package in packages]
+    write_published_file(published_dir, timestamp, "packages.json",
+                         json.dumps(dict(status=200, count=len(package_list), packages=package_list),
+                                    sort_keys=True).encode())
+    write_published_file(published_dir, timestamp, "main_page.json",
+                         json.dumps(dict(package_count=len(packages),
+                                         count_out_of_date=count_out_of_date,
+                                         report_formats=report_formats,
+                                         packages=sorted(package_list, key=lambda d: d["name"])),
+                                    sort_keys=True).encode())
+
+
+# Remove the published responses of all but the newest `keep` checks
+def remove_old_published(published_dir: str, keep: int):
+    if not os.path.isdir(published_dir):
+        return
+    timestamps = sorted((int(entry) for entry in os.listdir(published_dir) if entry.isdigit()), reverse=True)
+    for timestamp in timestamps[keep:]:
+        shutil.rmtree(os.path.join(published_dir, str(timestamp)), ignore_errors=True)
+
+
+### Report artifacts
+# main.py stores every report as <report_dir>/<hash of the report model>.<format>, so that an unchanged report is
+# neither rendered nor stored again. report_artifacts records the check that last produced each of them.
+def create_report_artifact_table(c):
+    c.execute("CREATE TABLE IF NOT EXISTS report_artifacts(hash CHAR, format CHAR, file CHAR, size INT, "
+              "unix_timestamp INT, PRIMARY KEY(hash, format))")
+    c.execute("CREATE INDEX IF NOT EXISTS report_artifacts_format ON report_artifacts(format, unix_timestamp)")
+
+
+# Returns the hash and file of the report of the latest check in the given format
+def get_latest_report_artifact(c, report_format: str) -> tuple | None:
+    c.execute("SELECT hash, file FROM report_artifacts WHERE format = ? ORDER BY unix_timestamp DESC LIMIT 1",
+              [report_format])
+    return c.fetchone()
+
+
+# Formats the report of a check has been stored in
+def get_report_artifact_formats(c, timestamp: int) -> [str]:
+    c.execute("SELECT format FROM report_artifacts WHERE unix_timestamp = ? ORDER BY format", [timestamp])
+    return [row[0] for row in c.fetchall()]
@@ -0,0 +1,68 @@
+# Micro-benchmark for DistroPackageStatus.getPackage(), which looks packages up in a name index, against the
+# linear scan it used before. Also checks that both find the same packages, after construction and after fromJSON().
+# Run from the repository root: python benchmarks/package_lookup.py
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import DistroPackage, DistroPackageStatus
+
+
+# DistroPackageStatus.getPackage() as it was before the name index
+def linear_get_package(status: DistroPackageStatus, name: str) -> DistroPackage | None:
+    for package in status.packages:
+        if package.package == name:
+            return package
+    return None
+
+
+# A status with `count` packages, of which a few share their name with another one
+def synthetic_status(rng: random.Random, count: int) -> DistroPackageStatus:
+    status = DistroPackageStatus(None)
+    for i in range(count):
+        name = "package-{}".format(rng.randrange(count) if rng.random() < 0.01 else i)
+        status.addPackage(DistroPackage(package=name,
+                                        version="1.{}".format(i),
+                                        upstream_version="1.{}".format(i + rng.randint(-1, 1)),
+                                        upstream_repo="nix-os-unstable",
+                                        found_upstream=True,
+                                        file="bootstrap.yml",
+                                        line=str(i)))
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare DistroPackageStatus.getPackage() against a linear scan")
+    parser.add_argument("--packages", type=int, default=5000, help="Number of packages in the status")
+    parser.add_argument("--lookups", type=int, default=5000, help="Number of lookups to time")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    status = synthetic_status(rng, args.packages)
+    # Some of the names are not in the status
+    names = ["package-{}".format(rng.randrange(int(args.packages * 1.1) + 1)) for _ in range(args.lookups)]
+
+    for description, checked_status in [("constructed", status),
+                                        ("restored with fromJSON()", DistroPackageStatus.fromJSON(status.toJSON()))]:
+        for name in set(names):
+            expected, got = linear_get_package(checked_status, name), checked_status.getPackage(name)
+            if expected != got:
+                print("Mismatch for {} in the {} status: expected {}, got {}".format(name, description, expected, got))
+                sys.exit(1)
+    print("Index agrees with a linear scan")
+
+    for description, function in [("linear scan", linear_get_package), ("index", DistroPackageStatus.getPackage)]:
+        start = time.perf_counter()
+        for name in names:
+            function(status, name)
+        print("{} lookups in {} packages with {}: {:.4f}s".format(args.lookups, args.packages, description,
+                                                                time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Benchmark of the report generation: building the report model from a status and its diff, and rendering the PDF.
+# Reports the time and the peak memory allocated while doing so, on synthetic distros of the given sizes.
+# Run from the repository root: python benchmarks/report.py
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from main import CachedXBDistro, CachedXBMetadata, CachedXBPackage, CachedXBSource, DistroPackage, \
+    DistroPackageStatus, DistroPackageStatusDiff, build_report_model, render_report_pdf
+
+
+def synthetic_package(rng: random.Random, i: int, upstream_bump: int) -> DistroPackage:
+    found_upstream = rng.random() < 0.9
+    # Some packages have long versions, which have to be wrapped in the tables
+    version = "1.{}".format(i) if rng.random() < 0.99 else "1.{}+git20260101.{:032x}".format(i, rng.getrandbits(128))
+    return DistroPackage(package="package-{:05d}".format(i),
+                         version=version,
+                         upstream_version="1.{}".format(i + rng.randint(-1, 1) + upstream_bump) if found_upstream
+                         else "Not found in repository (different name?)",
+                         upstream_repo="nix-os-unstable" if found_upstream else "",
+                         found_upstream=found_upstream,
+                         file="bootstrap.d/packages.yml",
+                         line=str(i))
+
+
+# A status of `count` packages, the status of a previous check it is compared against, and the distro they came from
+def synthetic_check(rng: random.Random, count: int) -> (DistroPackageStatus, DistroPackageStatus, CachedXBDistro):
+    current, old = DistroPackageStatus(None), DistroPackageStatus(None)
+    for i in range(count):
+        # A few packages have been added, removed or updated upstream since the previous check
+        if rng.random() < 0.98:
+            current.addPackage(synthetic_package(rng, i, 1 if rng.random() < 0.1 else 0))
+        if rng.random() < 0.98:
+            old.addPackage(synthetic_package(rng, i, 0))
+    distro = CachedXBDistro([CachedXBPackage(name=package.package, file=package.file, line=package.line,
+                                             source=CachedXBSource(version=package.version),
+                                             metadata=CachedXBMetadata(maintainer=None if rng.random() < 0.1
+                                                                       else "maintainer@example.org"))
+                             for package in current.packages])
+    return current, old, distro
+
+
+def generate_report(current: DistroPackageStatus, old: DistroPackageStatus) -> bytes:
+    report = build_report_model(current, DistroPackageStatusDiff(current, old),
+                                [("01/01/2026", 100, 1000)] * 5)
+    return render_report_pdf(report)
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark the report generation")
+    parser.add_argument("--packages", type=int, nargs="+", default=[2000, 10000],
+                        help="Numbers of packages to benchmark with")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for count in args.packages:
+        current, old, main.distro = synthetic_check(random.Random(args.seed), count)
+
+        start = time.perf_counter()
+        pdf = generate_report(current, old)
+        duration = time.perf_counter() - start
+
+        # Tracing slows everything down, so the memory is measured in a separate run
+        tracemalloc.start()
+        generate_report(current, old)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print("{} packages: {:.2f}s, peak memory {:.1f} MiB, {} KiB PDF".format(count, duration, peak / 1024 / 1024,
+                                                                               len(pdf) // 1024))
+
+
+if __name__ == '__main__':
+    main_benchmark()
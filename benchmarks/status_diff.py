@@ -0,0 +1,107 @@
+# Regression test and benchmark for DistroPackageStatusDiff.
+# Compares it against the original nested loop implementation on randomized package sets, and times both.
+# Run from the repository root: python benchmarks/status_diff.py
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import libversion
+from main import DistroPackage, DistroPackageStatus, DistroPackageStatusDiff
+
+DIFF_CATEGORIES = ["new_packages", "locally_updated_packages", "upstream_updated_packages",
+                   "newly_out_of_date_packages", "removed_packages"]
+
+
+# DistroPackageStatusDiff as it was before the packages were joined by name
+def old_status_diff(current: DistroPackageStatus, old: DistroPackageStatus) -> {str: [str]}:
+    diff: {str: [str]} = {category: [] for category in DIFF_CATEGORIES}
+    for package in current.packages:
+        old_package: DistroPackage | None = None
+        for old_package_search in old.packages:
+            if old_package_search.package == package.package:
+                old_package = old_package_search
+                break
+        if old_package is None:
+            diff["new_packages"].append(package.package)
+            continue
+        if libversion.version_compare2(package.version, old_package.version) > 0:
+            diff["locally_updated_packages"].append(package.package)
+        if libversion.version_compare2(package.upstream_version, old_package.upstream_version) > 0:
+            diff["upstream_updated_packages"].append(package.package)
+        if libversion.version_compare2(package.upstream_version, package.version) > 0 and \
+                libversion.version_compare2(old_package.upstream_version, old_package.version) <= 0:
+            diff["newly_out_of_date_packages"].append(package.package)
+
+    for package in old.packages:
+        new_package: DistroPackage | None = None
+        for new_package_search in current.packages:
+            if new_package_search.package == package.package:
+                new_package = new_package_search
+                break
+        if new_package is None and package.package not in diff["removed_packages"]:
+            diff["removed_packages"].append(package.package)
+    return diff
+
+
+def new_status_diff(current: DistroPackageStatus, old: DistroPackageStatus) -> {str: [str]}:
+    diff = DistroPackageStatusDiff(current, old)
+    return {category: getattr(diff, category) for category in DIFF_CATEGORIES}
+
+
+def random_version(rng: random.Random) -> str:
+    return ".".join(str(rng.randint(0, 3)) for _ in range(rng.randint(1, 3)))
+
+
+# A status with packages drawn from `names`, some of them twice, and some without an upstream version
+def random_status(rng: random.Random, names: [str], count: int) -> DistroPackageStatus:
+    status = DistroPackageStatus(None)
+    for name in rng.choices(names, k=count):
+        found_upstream = rng.random() < 0.9
+        status.addPackage(DistroPackage(package=name,
+                                        version=random_version(rng),
+                                        upstream_version=random_version(rng) if found_upstream
+                                        else "Not found in repository (different name?)",
+                                        upstream_repo="nix-os-unstable" if found_upstream else "",
+                                        found_upstream=found_upstream,
+                                        file="bootstrap.yml",
+                                        line="1"))
+    return status
+
+
+def random_status_pair(rng: random.Random, count: int) -> (DistroPackageStatus, DistroPackageStatus):
+    names = ["package-{}".format(i) for i in range(int(count * 1.2) + 1)]
+    return random_status(rng, names, count), random_status(rng, names, count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare DistroPackageStatusDiff against the old implementation")
+    parser.add_argument("--rounds", type=int, default=300, help="Number of randomized package sets to compare")
+    parser.add_argument("--packages", type=int, default=10000, help="Number of packages for the benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for i in range(args.rounds):
+        current, old = random_status_pair(rng, rng.randint(0, 200))
+        expected, got = old_status_diff(current, old), new_status_diff(current, old)
+        if expected != got:
+            print("Mismatch in round {}:".format(i))
+            for category in DIFF_CATEGORIES:
+                if expected[category] != got[category]:
+                    print("\t{}: expected {}, got {}".format(category, expected[category], got[category]))
+            sys.exit(1)
+    print("{} randomized package sets match".format(args.rounds))
+
+    current, old = random_status_pair(rng, args.packages)
+    for name, function in [("old", old_status_diff), ("new", new_status_diff)]:
+        start = time.perf_counter()
+        function(current, old)
+        print("{} diff of {} packages: {:.3f}s".format(name, args.packages, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,21 @@
+import argparse
 import copy
 import os
+import re
+import hashlib
+import functools
+import secrets
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from threading import Lock, local
 
 import XBStrapSQLite
-from git import Repo
+from git import Repo, GitCommandError
 from XBStrapDistro import XBStrapDistro
 from pprint import pprint
 
 import libversion
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
 
 # Needed for various things
 import yaml
@@ -15,7 +23,12 @@ import yaml
 # Needed for nix-os
 import json
 import brotli
-import urllib.request
+import codecs
+
+# Needed for other foreign repositories
+import gzip
+import lzma
+import tarfile
 
 # SQLite3
 import sqlite3
@@ -26,12 +39,16 @@ from contextlib import closing
 
 # PDF
 from fpdf import FPDF, XPos, YPos
+from jinja2 import Environment, FileSystemLoader
+import csv
+import io
 import time
 from datetime import date
 
 # Email
 import email, smtplib, ssl
 from email import encoders
+from email.policy import compat32
 from email.utils import parseaddr
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
@@ -48,9 +65,40 @@ repo_url: str = "https://github.com/managarm/bootstrap-managarm.git"
 repo_dir: str = "bootstrap-managarm"
 # Name of distribution
 distro_name: str = "Managarm"
+# Foreign repositories to compare against.
+# "type" selects the backend (see register_foreign_repository), the remaining entries are passed to it.
+# Besides NixOS, there are backends for Arch ("arch"), Debian ("debian") and Repology dumps ("repology"), e.g.:
+#   dict(type="arch", name="arch-extra", url="https://geo.mirror.pkgbuild.com/extra/os/x86_64/extra.db")
+#   dict(type="debian", name="debian-sid",
+#        url="https://deb.debian.org/debian/dists/sid/main/binary-amd64/Packages.xz")
+#   dict(type="repology", name="repology", file="repology-dump.json")
+# Instead of a "url", every repository can also be read from a local "file".
+foreign_repository_config: [dict] = [
+    dict(type="nix-os", branch="unstable"),
+]
+# Maximum number of worker processes used to download and index the foreign repositories.
+foreign_repository_workers: int = 4
+# Only re-evaluate packages whose definition or upstream version changed since the last check.
+incremental_checks: bool = True
+# Every this many checks, the full state is stored in the check history; in between, only the changes are stored.
+history_keyframe_interval: int = 30
+# Checks older than this many days are dropped from the history by "main.py compact". None keeps all checks.
+history_retention_days: int | None = None
+# Directory for the prebuilt responses served by the web server. Must match published_dir in wsgi.py.
+published_dir: str = "published"
+# Number of checks to keep the prebuilt responses of.
+published_checks_retained: int = 2
+# Seconds to wait for the web server to finish writing to packages.db before giving up.
+database_busy_timeout: float = 30
 # Maintain a complete SQLite3 database of the distro.
 # Used for some more advanced API calls in the Flask server.
 maintain_xbdistro_sqllite_database: bool = True
+# Formats to generate the report in, out of "pdf", "html", "json" and "csv".
+report_formats: [str] = ["pdf", "html", "json", "csv"]
+# Directory the reports are stored in, as <hash>.<format>.
+report_dir: str = "reports"
+# Number of distinct reports to keep. A report that did not change between checks only counts once.
+reports_retained: int = 30
 
 ## Send emails
 send_emails: bool = False
@@ -68,6 +116,14 @@ message_unsubscribe_contact_fill_in_email: bool = False
 # Fallback email address for packages without a maintainer
 # If empty, drop it
 no_maintainer_fallback_email = ""
+# Format of the report attached to the emails. Must be one of report_formats.
+email_report_format: str = "pdf"
+# Number of SMTP connections used to send emails in parallel.
+smtp_connections: int = 4
+# Sending an email is attempted this many times. After a failure, the next attempt is made after mail_retry_delay
+# seconds, which doubles after each attempt.
+mail_max_attempts: int = 5
+mail_retry_delay: float = 30
 
 # SMTP Host settings
 smtp_host: str = "localhost"
@@ -84,7 +140,14 @@ smtp_login_user: str = smtp_email_address
 smtp_login_password: str = ""
 
 ### CODE
+# Replaced by a CachedXBDistro if the package list can be restored from the cache, see perform_init()
 distro = XBStrapDistro(repo_dir)
+# Commit of the bootstrap repository that the distro has been read from
+distro_commit: str = ""
+# Parsed package list of the distro, see perform_init()
+distro_cache_file: str = "xbdistro-cache.json"
+# Key of the parsed package list, it is saved under this once everything derived from it is up to date
+distro_cache_key: dict | None = None
 nix_os_repo = "https://channels.nixos.org/nixos-{}/packages.json.br"
 
 ssl_context = ssl.create_default_context()
@@ -107,85 +170,290 @@ class ReportPDF(FPDF):
         self.cell(0, 10, 'Page ' + str(self.page_no()) + '/{nb}', 0, new_x=XPos.RIGHT, new_y=YPos.TOP, align='C')
 
 
-class NixOSRepository(ForeignRepository):
-    def __do_package_sql(self, c: sqlite3.Cursor, package: (str, str)) -> str:
-        # Check if the package is known
-        c.execute("SELECT EXISTS (SELECT 1 FROM nix_os_{} WHERE package='{}')".format(self.branch, package[0]))
-        if not c.fetchone()[0]:
-            # Package not known, add and return "new"
-            c.execute("INSERT INTO nix_os_{}(package, version) VALUES('{}', '{}')".format(self.branch, package[0],
-                                                                                          package[1]))
-            return "new"
-        else:
-            # Check if we know the correct version already
-            c.execute("SELECT version FROM nix_os_{} WHERE package='{}'".format(self.branch, package[0]))
-            if c.fetchone()[0] == package[1]:
-                return ""
-            # Its different, update it
-            c.execute(
-                "UPDATE nix_os_{} SET version='{}' WHERE package='{}'".format(self.branch, package[1], package[0]))
-            return "updated"
+# Decompress a brotli file in chunks, yielding the decoded text.
+def read_brotli_text(file: str, chunk_size: int = 64 * 1024):
+    decompressor = brotli.Decompressor()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    with open(file, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield text_decoder.decode(decompressor.process(chunk))
+    if not decompressor.is_finished():
+        raise brotli.error("Brotli file '{}' is truncated".format(file))
+    yield text_decoder.decode(b"", final=True)
+
+
+# Read a (possibly compressed) text file in chunks, picking the decompressor by the file extension.
+def read_text_chunks(file: str, chunk_size: int = 64 * 1024):
+    if file.endswith(".br"):
+        yield from read_brotli_text(file, chunk_size)
+        return
+    if file.endswith(".gz"):
+        opener = gzip.open
+    elif file.endswith(".xz"):
+        opener = lzma.open
+    else:
+        opener = open
+    with opener(file, "rt", encoding="utf-8") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+# Strip the epoch ("1:") and the packaging revision ("-1") from a distribution package version,
+# leaving the upstream version
+def strip_distro_version(version: str) -> str:
+    if ":" in version:
+        version = version.split(":", 1)[1]
+    if "-" in version:
+        version = version.rsplit("-", 1)[0]
+    return version
+
+
+# Base for repositories that are read from a single file, which is streamed into a PackageVersionIndex.
+# Subclasses only have to implement iterate_packages().
+#
+# Repositories are either downloaded from `url`, or read from the local `file` (e.g. for testing).
+# New and updated packages are tracked in the SQL table `sql_table`.
+class IndexedForeignRepository(ForeignRepository):
+    def __init__(self, name: str, url: str | None = None, file: str | None = None, data_file: str | None = None,
+                 sql_table: str | None = None):
+        if url is None and file is None:
+            raise ValueError("Foreign repository '{}' needs either a url or a file".format(name))
+        self.canonical_repo_name = name
+        super().__init__()
+        self.url = url
+        self.data_file = file if file is not None else data_file
+        if self.data_file is None:
+            self.data_file = "packages-{}{}".format(name, os.path.splitext(url)[1])
+        # Version index of the last import, so that we don't have to parse the data again
+        self.package_index_file = "packages-{}.idx".format(name)
+        self.sql_table = sql_table if sql_table is not None else "foreign_" + re.sub(r"[^A-Za-z0-9_]", "_", name)
+        self.package_index: PackageVersionIndex | None = None
+        # Set by update_database() if the index built by fetch() still has to be moved into place
+        self.index_updated = False
+
+    # Iterates over the (name, pname, version) tuples of all packages in the data file
+    def iterate_packages(self):
+        raise NotImplementedError
+
+    # Compare the current index against the change tracking table, and report new and updated packages
+    def __find_changed_packages(self, c: sqlite3.Cursor) -> [ForeignPackage]:
+        c.execute("SELECT package, version FROM {}".format(self.sql_table))
+        known_versions: {str: str} = dict(c.fetchall())
+
+        report: [ForeignPackage] = []
+        for package, version in self.package_index.items():
+            known_version = known_versions.get(package)
+            if known_version == version:
+                continue
+            report.append(ForeignPackage(package=package, version=version,
+                                         update_status="new" if known_version is None else "updated"))
+        return report
 
     def get_repo_name(self) -> str:
-        return "nix-os-{}".format(self.branch)
+        return self.canonical_repo_name
 
     def get_local_package_version(self, name: str) -> str | None:
-        if name in self.package_json["packages"]:
-            return self.package_json["packages"][name]["version"]
-        elif name in self.pname_translation:
-            return self.package_json["packages"][self.pname_translation[name]]["version"]
+        return self.package_index.lookup(name)
+
+    def get_local_package_record(self, name: str) -> str | None:
+        return self.package_index.resolve_name(name)
+
+    # Download the data and build the package index.
+    # This does not touch the database or keep any state, so that it can be run in a worker process.
+    # Returns True if a new index has been built, which then has to be passed to update_database().
+    def fetch(self) -> bool:
+        print("Importing repository {}".format(self.canonical_repo_name))
+        if self.url is not None:
+            changed = download_file_cached(self.url, self.data_file)
         else:
-            return None
-
-    def __init__(self, c: sqlite3.Cursor, branch: str):
-        self.canonical_repo_name = "nix-os-{}".format(branch)
-        super().__init__()
-        global nix_os_repo
-        self.branch = branch
-        self.url = nix_os_repo.format(branch)
-        self.package_brotli_file = "packages-nixos-{}.json.br".format(branch)
+            # Local files are always re-indexed, that is cheap enough
+            changed = True
+        if not changed and os.path.exists(self.package_index_file):
+            # The data has not changed since the last run, so there is nothing new to put into the database either
+            try:
+                PackageVersionIndex(self.package_index_file).close()
+                print("Repository {} has not changed, using cached package index".format(self.canonical_repo_name))
+                return False
+            except ValueError as exc:
+                print("Could not use cached package index, rebuilding it:", exc)
+
+        print("Building package index for {}".format(self.canonical_repo_name))
+        # It is only moved into place once the database has been updated, see finish_update()
+        PackageVersionIndex.build(self.package_index_file + ".new", self.iterate_packages()).close()
+        return True
+
+    # Open the index built by fetch(), and find the changes in it.
+    # They are only written by save_changes() along with the check, so that a failed run reports the same changes
+    # again the next time.
+    def update_database(self, c: sqlite3.Cursor, changed: bool):
         # Ensure the SQL table exists
-        c.execute("CREATE TABLE IF NOT EXISTS nix_os_{}(package CHAR PRIMARY KEY, version CHAR)".format(branch))
-
-        print("Importing NixOS repository, branch {}".format(branch))
-        urllib.request.urlretrieve(self.url, self.package_brotli_file)
-        with open(self.package_brotli_file, "rb") as file:
-            self.package_raw_json = brotli.decompress(file.read())
-        self.package_json = json.loads(self.package_raw_json)
-
-        packages = []
-        self.pname_translation = {}
-        print("Getting package pnames")
-        for package in self.package_json["packages"]:
-            packages.append((package, self.package_json["packages"][package]["version"]))
-            self.pname_translation[self.package_json["packages"][package]["pname"]] = package
+        c.execute("CREATE TABLE IF NOT EXISTS {}(package CHAR PRIMARY KEY, version CHAR)".format(self.sql_table))
+        if not changed:
+            self.package_index = PackageVersionIndex(self.package_index_file)
+            return
 
+        self.package_index = PackageVersionIndex(self.package_index_file + ".new")
         print("Doing SQL stuff")
-        for package in packages:
-            report = self.__do_package_sql(c, package)
-            if report != "":
-                package_report = ForeignPackage
-                package_report.package = package[0]
-                package_report.version = package[1]
-                package_report.update_status = report
-                self.change_report.packages.append(package_report)
-        pprint(self.change_report)
+        self.change_report.packages = self.__find_changed_packages(c)
+        print("{} new or updated packages in {}".format(len(self.change_report.packages), self.canonical_repo_name))
+        self.index_updated = True
+
+    def save_changes(self, c: sqlite3.Cursor):
+        c.executemany("INSERT INTO {}(package, version) VALUES(?, ?) "
+                      "ON CONFLICT(package) DO UPDATE SET version = excluded.version".format(self.sql_table),
+                      [(package.package, package.version) for package in self.change_report.packages])
+
+    # The database agrees with the new index now, so that a later run may skip downloading and building it
+    def finish_update(self):
+        if self.index_updated:
+            os.replace(self.package_index_file + ".new", self.package_index_file)
+            self.index_updated = False
+        if self.url is not None:
+            commit_download_cache(self.data_file)
+
+
+# NixOS channel, from the packages.json.br that is published with every channel
+@register_foreign_repository("nix-os")
+class NixOSRepository(IndexedForeignRepository):
+    def __init__(self, branch: str, url: str | None = None, file: str | None = None):
+        global nix_os_repo
+        self.branch = branch
+        super().__init__("nix-os-{}".format(branch),
+                         url=nix_os_repo.format(branch) if url is None and file is None else url,
+                         file=file,
+                         data_file="packages-nixos-{}.json.br".format(branch),
+                         sql_table="nix_os_{}".format(branch))
+        self.package_index_file = "packages-nixos-{}.idx".format(branch)
+
+    def iterate_packages(self):
+        # Stream the channel, only keeping the name, pname and version of each package
+        for package, package_info in iterate_json_object_entries(read_text_chunks(self.data_file), "packages"):
+            yield package, package_info["pname"], package_info["version"]
+
+
+# Arch Linux style repository database (e.g. extra.db), a tarball with a "desc" file per package
+@register_foreign_repository("arch")
+class ArchRepository(IndexedForeignRepository):
+    def iterate_packages(self):
+        with tarfile.open(self.data_file, mode="r|*") as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.endswith("/desc"):
+                    continue
+                # The desc file is a list of "%FIELD%" headers, each followed by its values and an empty line
+                fields: {str: [str]} = {}
+                field: str | None = None
+                for line in tar.extractfile(member).read().decode().splitlines():
+                    if line.startswith("%") and line.endswith("%"):
+                        field = line[1:-1]
+                        fields[field] = []
+                    elif line and field is not None:
+                        fields[field].append(line)
+                if not fields.get("NAME") or not fields.get("VERSION"):
+                    continue
+                yield fields["NAME"][0], fields.get("BASE", [None])[0], strip_distro_version(fields["VERSION"][0])
+
+
+# Debian style package index (Packages, Packages.gz or Packages.xz)
+@register_foreign_repository("debian")
+class DebianRepository(IndexedForeignRepository):
+    def iterate_packages(self):
+        opener = gzip.open if self.data_file.endswith(".gz") else lzma.open if self.data_file.endswith(".xz") else open
+        with opener(self.data_file, "rt", encoding="utf-8") as f:
+            fields: {str: str} = {}
+            for line in itertools.chain(f, [""]):
+                line = line.rstrip("\n")
+                if line:
+                    # Continuation lines start with whitespace, we do not need any multi-line fields
+                    if not line[0].isspace() and ":" in line:
+                        key, value = line.split(":", 1)
+                        fields[key] = value.strip()
+                    continue
+                # An empty line ends the paragraph of a package
+                if "Package" in fields and "Version" in fields:
+                    # The source field may carry its own version in brackets
+                    source = fields.get("Source", fields["Package"]).split(" ", 1)[0]
+                    # Repacked upstream sources are marked with a suffix, e.g. "1.3+dfsg"
+                    version = re.sub(r"[+~.](dfsg|ds|repack)[0-9]*$", "", strip_distro_version(fields["Version"]))
+                    yield fields["Package"], source, version
+                fields = {}
+
+
+# Repology style dump: a JSON object mapping project names to a list of packages in different repositories
+@register_foreign_repository("repology")
+class RepologyRepository(IndexedForeignRepository):
+    def iterate_packages(self):
+        reader = JSONStreamReader(read_text_chunks(self.data_file))
+        for project in reader.object_keys():
+            newest: str | None = None
+            for package in reader.value():
+                version = package.get("version")
+                if version is None:
+                    continue
+                # Prefer what repology has already determined to be the newest version
+                if package.get("status") == "newest":
+                    newest = version
+                    break
+                if newest is None or libversion.version_compare2(version, newest) > 0:
+                    newest = version
+            if newest is not None:
+                yield project, None, newest
 
 
 @dataclass
 class DistroPackageStatus:
     packages: [DistroPackage]
 
-    def __init__(self, xb_distro: XBStrapDistro | None):
+    # If `previous` and `changed_files` are given, packages are only re-evaluated if their definition, rules or
+    # upstream records have changed since the previous check; all other packages are taken over from it.
+    # `changed_files` are the paths (relative to the bootstrap repository) that changed since the previous check.
+    # `previous_records` are the upstream records the packages resolved to in the previous check, see
+    # load_upstream_records(); packages that resolve to a different record now are re-evaluated as well.
+    def __init__(self, xb_distro: XBStrapDistro | None, previous: "DistroPackageStatus | None" = None,
+                 changed_files: {str} = None, previous_records: dict | None = None):
         self.packages = []
+        # Package name -> package, for getPackage()
+        self.package_index = {}
 
         if xb_distro is None:
             return
 
         global global_rules
+        xb_packages = []
         for xb_package in xb_distro.packages:
             package_name = global_rules.translatePackage(xb_package.name)
-            if package_name is None:
+            if package_name is not None:
+                xb_packages.append((package_name, xb_package))
+
+        # Find the packages we can take over from the previous check
+        reused_packages: {str: DistroPackage} = {}
+        if previous is not None and changed_files is not None and previous_records is not None:
+            changed_records = get_changed_upstream_records()
+            for package_name, xb_package in xb_packages:
+                old_package = previous.getPackage(package_name)
+                if (old_package is not None and
+                        old_package.version == xb_package.source.version and
+                        old_package.file == xb_package.file and
+                        old_package.line == str(xb_package.line) and
+                        get_repo_relative_path(xb_package.file) not in changed_files and
+                        not is_upstream_changed(package_name, changed_records, previous_records.get(package_name))):
+                    reused_packages[package_name] = old_package
+            print("Re-evaluating {} of {} packages".format(len(xb_packages) - len(reused_packages), len(xb_packages)))
+
+        # Resolve all packages against the foreign repositories in one batch
+        # If this is a rolling version package, then just fail, as we cant accurately compare the version here
+        upstream_results: {str: UpstreamRequest} = get_most_up_to_date_upstream_packages(
+            [package_name for package_name, xb_package in xb_packages
+             if "ROLLING" not in xb_package.source.version and package_name not in reused_packages])
+
+        for package_name, xb_package in xb_packages:
+            if package_name in reused_packages:
+                self.addPackage(copy.copy(reused_packages[package_name]))
                 continue
 
             # Get upstream version and repo, and fill with blank if not found
@@ -193,11 +461,10 @@ class DistroPackageStatus:
             upstream_version: str = ""
             upstream_repo: str = ""
 
-            # If this is a rolling version package, then just fail, as we cant accurately compare the version here
             if "ROLLING" in xb_package.source.version:
                 upstream_version = "Rolling version"
             else:
-                upstream_result: UpstreamRequest = get_most_up_to_date_upstream_package(package_name)
+                upstream_result: UpstreamRequest = upstream_results[package_name]
                 if upstream_result.found:
                     upstream_version = upstream_result.upstream_version
                     upstream_repo = upstream_result.newest_repo
@@ -211,11 +478,20 @@ class DistroPackageStatus:
                                                    upstream_repo=upstream_repo,
                                                    found_upstream=found_upstream,
                                                    file=xb_package.file,
-                                                   line=xb_package.line)
-            self.packages.append(package)
+                                                   # Stored as a string, so it is the same for reused packages
+                                                   line=str(xb_package.line))
+            # Compare once here, so that the result is stored along with the package
+            package.compare_to_upstream()
+            self.addPackage(package)
 
     def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+        # The package index is not serialized, it is rebuilt by fromJSON()
+        return json.dumps(dict(packages=self.packages), default=lambda o: o.__dict__, sort_keys=True, indent=4)
+
+    def addPackage(self, package: DistroPackage):
+        self.packages.append(package)
+        # If a name shows up twice, keep returning the first one
+        self.package_index.setdefault(package.package, package)
 
     @staticmethod
     def fromJSON(json_data: str):
@@ -238,27 +514,32 @@ class DistroPackageStatus:
                                                    upstream_repo=package["upstream_repo"],
                                                    found_upstream=package["found_upstream"],
                                                    file=package["file"],
-                                                   line=package["line"])
-            ret.packages.append(package)
+                                                   line=str(package["line"]),
+                                                   upstream_compare=package.get("upstream_compare"))
+            ret.addPackage(package)
+        return ret
+
+    @staticmethod
+    def fromSnapshot(c: sqlite3.Cursor, timestamp: int):
+        ret: DistroPackageStatus = DistroPackageStatus(None)
+        for package in load_snapshot(c, timestamp):
+            ret.addPackage(package)
         return ret
 
     def countOutOfDate(self):
         result: int = 0
         for package in self.packages:
-            if libversion.version_compare2(package.version, package.upstream_version) < 0:
+            if package.is_out_of_date():
                 result += 1
         return result
 
     def getPackage(self, name: str) -> DistroPackage | None:
-        for package in self.packages:
-            if package.package == name:
-                return package
-        return None
+        return self.package_index.get(name)
 
     def getOutOfDatePackages(self) -> [DistroPackage]:
         ret: [DistroPackage] = []
         for package in self.packages:
-            if libversion.version_compare2(package.upstream_version, package.version) > 0:
+            if package.is_out_of_date():
                 ret.append(package)
         return ret
 
@@ -279,14 +560,9 @@ class DistroPackageStatusDiff:
         self.removed_packages = []
 
         # We want to check if a package is new, has been removed, has gotten in date, or has gone further out of date
-        # First, we iterate over the current set of packages
+        # First, we iterate over the current set of packages, joining them with the old ones by name
         for package in current.packages:
-            # Get this package in old
-            old_package: DistroPackage | None = None
-            for old_package_search in old.packages:
-                if old_package_search.package == package.package:
-                    old_package = old_package_search
-                    break
+            old_package: DistroPackage | None = old.getPackage(package.package)
             if old_package is None:
                 self.new_packages.append(package.package)
                 continue
@@ -300,42 +576,122 @@ class DistroPackageStatusDiff:
                 self.upstream_updated_packages.append(package.package)
 
             # Check if a package that was in date has gotten out of date
-            if libversion.version_compare2(package.upstream_version,
-                                           package.version) > 0 and libversion.version_compare2(
-                old_package.upstream_version, old_package.version) <= 0:
+            if package.is_out_of_date() and not old_package.is_out_of_date():
                 self.newly_out_of_date_packages.append(package.package)
 
-        # Now itereate through the old package list, checking that each package is also present in the new one,
-        # and adding them to the removed list if they are not
+        # Now iterate through the old package list, adding each package that is not present in the new one to
+        # the removed list
+        removed: {str} = set()
         for package in old.packages:
-            new_package: DistroPackage | None = None
-            for new_package_search in current.packages:
-                if new_package_search.package == package.package:
-                    new_package = new_package_search
-                    break
-            if new_package is None and package.package not in self.removed_packages:
+            if package.package not in removed and current.getPackage(package.package) is None:
+                removed.add(package.package)
                 self.removed_packages.append(package.package)
 
 
 foreign_repositories: [ForeignRepository] = []
 # Name, Upstream Version
 packages_out_of_date: {str} = {}
+# Repository name -> step -> seconds, printed at the end of the run
+repository_timings: {str: {str: float}} = {}
+
+
+def add_repository_timing(repo: ForeignRepository, step: str, seconds: float):
+    timings = repository_timings.setdefault(repo.get_repo_name(), {})
+    timings[step] = timings.get(step, 0.0) + seconds
 
 
-def get_most_up_to_date_upstream_package(name: str) -> UpstreamRequest:
-    result: UpstreamRequest = UpstreamRequest(upstream_version="", newest_repo="", found=False)
+# Runs in a worker process, see load_foreign_repositories()
+def fetch_foreign_repository(repo: ForeignRepository) -> (bool, float):
+    start = time.perf_counter()
+    changed = repo.fetch()
+    return changed, time.perf_counter() - start
+
+
+def load_foreign_repositories(c: sqlite3.Cursor):
+    repositories: [ForeignRepository] = [create_foreign_repository(config) for config in foreign_repository_config]
+
+    # Downloading and indexing is independent for every repository, so do it concurrently
+    with ProcessPoolExecutor(max_workers=max(1, min(foreign_repository_workers, len(repositories)))) as executor:
+        futures = [executor.submit(fetch_foreign_repository, repo) for repo in repositories]
+        results = [future.result() for future in futures]
+
+    # The database is only updated from this process
+    for repo, (changed, fetch_time) in zip(repositories, results):
+        add_repository_timing(repo, "fetch", fetch_time)
+        start = time.perf_counter()
+        repo.update_database(c, changed)
+        add_repository_timing(repo, "database", time.perf_counter() - start)
+        foreign_repositories.append(repo)
+
+
+# Find the newest upstream version of all the given packages.
+# Every repository is queried for the whole list in one go, instead of querying every repository per package.
+def get_most_up_to_date_upstream_packages(names: [str]) -> {str: UpstreamRequest}:
+    results: {str: UpstreamRequest} = {name: UpstreamRequest(upstream_version="", newest_repo="", found=False)
+                                       for name in names}
     for repo in foreign_repositories:
-        upstream_version = repo.get_package_version(name)
-        if result.found == False and upstream_version is not None:
-            result = UpstreamRequest(upstream_version=upstream_version, newest_repo=repo.get_repo_name(), found=True)
-        elif upstream_version is not None:
-            if libversion.version_compare2(upstream_version, result.upstream_version) > 0:
-                result = UpstreamRequest(upstream_version=upstream_version, newest_repo=repo.get_repo_name(),
-                                         found=True)
-    return result
+        start = time.perf_counter()
+        repo_name = repo.get_repo_name()
+        for name in names:
+            upstream_version = repo.get_package_version(name)
+            if upstream_version is None:
+                continue
+            result = results[name]
+            if not result.found or libversion.version_compare2(upstream_version, result.upstream_version) > 0:
+                results[name] = UpstreamRequest(upstream_version=upstream_version, newest_repo=repo_name, found=True)
+        add_repository_timing(repo, "resolve", time.perf_counter() - start)
+    return results
+
+
+# Repository name -> names of the records that are new or updated in this run
+def get_changed_upstream_records() -> {str: {str}}:
+    return {repo.get_repo_name(): set(package.package for package in repo.get_change_report().packages)
+            for repo in foreign_repositories}
 
 
-def update_git_repo():
+# Check if any of the upstream records a package resolves to have changed since it was last evaluated.
+# `previous_records` are the records it resolved to back then.
+def is_upstream_changed(name: str, changed_records: {str: {str}}, previous_records: dict | None) -> bool:
+    if previous_records is None:
+        return True
+    for repo in foreign_repositories:
+        record = repo.get_package_record(name)
+        # The record the package resolved to might have been removed, and another one might have taken its place
+        if record != previous_records.get(repo.get_repo_name()):
+            return True
+        if record is not None and record in changed_records[repo.get_repo_name()]:
+            return True
+    return False
+
+
+# Remember the upstream record of every repository each package resolves to, for the next incremental check.
+# Only the records of the latest check are kept.
+def save_upstream_records(c: sqlite3.Cursor, timestamp: int, names: [str]):
+    c.executemany("INSERT OR IGNORE INTO check_upstream_records(unix_timestamp, package, repo, record) "
+                  "VALUES(?, ?, ?, ?)",
+                  [(timestamp, name, repo.get_repo_name(), repo.get_package_record(name))
+                   for name in names for repo in foreign_repositories])
+    c.execute("DELETE FROM check_upstream_records WHERE unix_timestamp < ?", [timestamp])
+
+
+# Package name -> repository name -> record, or None if no records have been stored for the check
+def load_upstream_records(c: sqlite3.Cursor, timestamp: int) -> dict | None:
+    c.execute("SELECT package, repo, record FROM check_upstream_records WHERE unix_timestamp = ?", [timestamp])
+    records: {str: {str: str | None}} = {}
+    for name, repo_name, record in c.fetchall():
+        records.setdefault(name, {})[repo_name] = record
+    return records if len(records) else None
+
+
+def print_repository_timings():
+    print("Foreign repository timings:")
+    for repo_name, timings in repository_timings.items():
+        print("\t{}: {}".format(repo_name, ", ".join("{} {:.2f}s".format(step, seconds)
+                                                     for step, seconds in timings.items())))
+
+
+# Returns the commit the repository is at afterwards
+def update_git_repo() -> str:
     if os.path.exists(os.path.join(repo_dir, ".git")):
         repo = Repo(repo_dir)
         assert not repo.bare
@@ -344,25 +700,243 @@ def update_git_repo():
     else:
         repo = Repo.clone_from(repo_url, repo_dir)
         assert not repo.bare
+    return repo.head.commit.hexsha
+
+
+# Stand-ins for the parts of the xbstrap distro we use, restored from the distro cache
+@dataclass
+class CachedXBSource:
+    version: str
+
+
+@dataclass
+class CachedXBMetadata:
+    maintainer: str | None
+
+
+@dataclass
+class CachedXBPackage:
+    name: str
+    file: str
+    line: str
+    source: CachedXBSource
+    metadata: CachedXBMetadata
+
+
+class CachedXBDistro:
+    def __init__(self, packages: [CachedXBPackage]):
+        self.packages = packages
+        self.package_index = {}
+        for package in packages:
+            self.package_index.setdefault(package.name, package)
+
+    def find_package_by_name(self, name: str) -> CachedXBPackage | None:
+        return self.package_index.get(name)
+
+
+# The distro cache is valid as long as the bootstrap repository is at the same commit, and none of its YAML files
+# have been touched since
+def get_distro_cache_key(commit: str) -> dict:
+    files: dict = {}
+    for root, dirs, filenames in os.walk(repo_dir):
+        if ".git" in dirs:
+            dirs.remove(".git")
+        for filename in filenames:
+            if filename.endswith(".yml") or filename.endswith(".yaml"):
+                stat = os.stat(os.path.join(root, filename))
+                files[os.path.relpath(os.path.join(root, filename), repo_dir)] = [stat.st_mtime_ns, stat.st_size]
+    return dict(commit=commit, files=files)
+
+
+def load_distro_cache(cache_key: dict) -> CachedXBDistro | None:
+    try:
+        with open(distro_cache_file, "r") as file:
+            cache = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if cache.get("key") != cache_key:
+        return None
+    return CachedXBDistro([CachedXBPackage(name=package["name"],
+                                           file=package["file"],
+                                           line=package["line"],
+                                           source=CachedXBSource(version=package["version"]),
+                                           metadata=CachedXBMetadata(maintainer=package["maintainer"]))
+                           for package in cache["packages"]])
+
+
+def save_distro_cache(cache_key: dict, xb_distro: XBStrapDistro):
+    packages = [dict(name=package.name,
+                     version=package.source.version,
+                     file=package.file,
+                     line=package.line,
+                     maintainer=package.metadata.maintainer) for package in xb_distro.packages]
+    with open(distro_cache_file + ".tmp", "w") as file:
+        json.dump(dict(key=cache_key, packages=packages), file)
+    os.replace(distro_cache_file + ".tmp", distro_cache_file)
+
+
+# Path of a file of the distro, relative to the bootstrap repository
+def get_repo_relative_path(file: str) -> str:
+    if os.path.isabs(file) or os.path.normpath(file).startswith(os.path.normpath(repo_dir) + os.sep):
+        return os.path.relpath(file, repo_dir)
+    return os.path.normpath(file)
+
+
+# Hash of all rule files, as changing a rule can change the result of any package
+def get_rules_hash() -> str:
+    rules_hash = hashlib.sha256()
+    for filename in sorted(os.listdir("rules")):
+        rules_hash.update(filename.encode() + b"\0")
+        with open(os.path.join("rules", filename), "rb") as file:
+            rules_hash.update(file.read())
+    return rules_hash.hexdigest()
+
+
+# Files of the bootstrap repository that changed since the given check state, or None if we can't tell
+# (in which case all packages have to be re-evaluated)
+def get_changed_files_since(c: sqlite3.Cursor, previous_timestamp: int) -> set[str] | None:
+    c.execute("SELECT commit_sha, rules_hash, repositories FROM check_state WHERE unix_timestamp = ?",
+              [previous_timestamp])
+    state = c.fetchone()
+    if state is None:
+        return None
+    previous_commit, previous_rules_hash, previous_repositories = state
+    if previous_rules_hash != get_rules_hash():
+        print("Rules have changed since the last check")
+        return None
+    if json.loads(previous_repositories) != sorted(repo.get_repo_name() for repo in foreign_repositories):
+        print("Foreign repositories have changed since the last check")
+        return None
+    try:
+        # Compare against the working tree, so that local changes are picked up as well
+        diff = Repo(repo_dir).git.diff("--name-only", previous_commit)
+    except GitCommandError as exc:
+        print("Could not diff against the last checked commit:", exc)
+        return None
+    return set(os.path.normpath(path) for path in diff.splitlines() if path)
 
 
-def perform_init():
+# Returns True if the distro has been restored from the cache, instead of being parsed.
+# Otherwise, the cache has to be saved with save_distro_cache() once the xbdistro database has been updated.
+def perform_init(use_cache: bool = True) -> bool:
+    global distro, distro_commit, distro_cache_key
     print("Initializing git repository")
-    update_git_repo()
+    distro_commit = update_git_repo()
+
+    # Take the key before parsing, so that files changed in the meantime are read again the next time
+    distro_cache_key = get_distro_cache_key(distro_commit)
+    cached_distro = load_distro_cache(distro_cache_key) if use_cache else None
+    if cached_distro is not None:
+        print("Bootstrap repository has not changed, using cached package list")
+        distro = cached_distro
+        return True
+
     print("Reading global sources")
     distro.import_global_sources("bootstrap.yml")
     print("Reading packages")
     distro.import_packages("bootstrap.yml")
+    return False
 
 
 def perform_db_init(c: sqlite3.Cursor):
-    c.execute(
-        "CREATE TABLE IF NOT EXISTS previous_check_json(unix_timestamp INT PRIMARY KEY, json_distro_state_b64 CHAR)")
+    create_snapshot_tables(c)
+    migrate_previous_check_json(c)
+    migrate_snapshot_history(c, history_keyframe_interval)
+    migrate_package_history(c)
     c.execute(
         "CREATE TABLE IF NOT EXISTS check_metadata(last_check CHAR, amount_ood INT, amount INT, unix_timestamp INT PRIMARY KEY)")
     c.execute("CREATE TABLE IF NOT EXISTS generic_email_recipients(email CHAR PRIMARY KEY)")
     c.execute("CREATE TABLE IF NOT EXISTS generic_email_unsubscribe_key(email CHAR PRIMARY KEY, code CHAR)")
     c.execute("CREATE TABLE IF NOT EXISTS generic_email_subscribe_key(code CHAR PRIMARY KEY, email CHAR)")
+    create_report_artifact_table(c)
+    create_mail_outbox_table(c)
+    c.execute("CREATE TABLE IF NOT EXISTS check_state(unix_timestamp INT PRIMARY KEY, commit_sha CHAR, rules_hash CHAR, "
+              "repositories CHAR)")
+    c.execute("CREATE TABLE IF NOT EXISTS check_upstream_records(unix_timestamp INT, package CHAR, repo CHAR, "
+              "record CHAR, PRIMARY KEY(unix_timestamp, package, repo)) WITHOUT ROWID")
+
+
+# Move the checks stored as base64 encoded JSON blobs by older versions into the snapshot tables
+def migrate_previous_check_json(c: sqlite3.Cursor):
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'previous_check_json'")
+    if c.fetchone() is None:
+        return
+    c.execute("SELECT unix_timestamp, json_distro_state_b64 FROM previous_check_json ORDER BY unix_timestamp")
+    blobs = c.fetchall()
+    print("Migrating {} stored checks to the snapshot tables".format(len(blobs)))
+    for timestamp, base64_encoded in blobs:
+        c.execute("SELECT 1 FROM snapshots WHERE unix_timestamp = ?", [timestamp])
+        if c.fetchone() is not None:
+            continue
+        save_snapshot(c, timestamp, DistroPackageStatus.fromJSON(base64.b64decode(base64_encoded)).packages,
+                      history_keyframe_interval)
+    c.execute("DROP TABLE previous_check_json")
+    c.connection.commit()
+    # Give the space used by the blobs back
+    c.execute("VACUUM")
+
+
+# A section of the report, listing packages in a table
+@dataclass
+class ReportSection:
+    heading: str
+    description: str
+    columns: [str]
+    rows: [[str]]
+
+
+# Sort the packages into the sections of the report, in a single pass over the current status
+def get_report_sections(current_distro_status: DistroPackageStatus,
+                        diff: DistroPackageStatusDiff | None) -> [ReportSection]:
+    columns = ["Package Name", "Local Version", "Upstream Version"]
+    newly_out_of_date = ReportSection("Newly out of date", "The following packages have gotten out of date:",
+                                      columns, [])
+    upstream_updated = ReportSection("Updated upstream", "The following packages have been updated upstream:",
+                                     columns, [])
+    locally_updated = ReportSection("Updated locally", "The following packages have been updated locally:",
+                                    columns, [])
+    new = ReportSection("New packages", "The following packages have been added:", columns, [])
+    removed = ReportSection("Removed packages",
+                            "The following packages have been removed from reporting\n(either they are no longer"
+                            "available as packages, or they have been added to the ignore list):",
+                            ["Package Name"], [])
+    out_of_date = ReportSection("Out of date packages", "In total, the following packages are out of date:",
+                                columns, [])
+    maintainerless = ReportSection("Packages without maintainers",
+                                   "In total, the following packages have no defined maintainer:", columns, [])
+    newer_than_upstream = ReportSection("Packages newer than known upstream versions",
+                                        "In total, the following packages are newer than any known upstream version:",
+                                        columns, [])
+
+    # Which diff sections each package belongs to
+    diff_sections: {str: [ReportSection]} = {}
+    if diff is not None:
+        for section, names in [(newly_out_of_date, diff.newly_out_of_date_packages),
+                               (upstream_updated, diff.upstream_updated_packages),
+                               (locally_updated, diff.locally_updated_packages),
+                               (new, diff.new_packages)]:
+            for name in names:
+                diff_sections.setdefault(name, []).append(section)
+        removed.rows = [[name] for name in diff.removed_packages]
+
+    maintainerless_names: {str} = {distro_package.name for distro_package in distro.packages
+                                   if not distro_package.metadata.maintainer}
+
+    for package in current_distro_status.packages:
+        row = [package.package, package.version, package.upstream_version]
+        for section in diff_sections.get(package.package, []):
+            section.rows.append(row)
+        if package.is_out_of_date():
+            out_of_date.rows.append(row)
+        if package.package in maintainerless_names:
+            maintainerless.rows.append(row)
+        if package.is_local_rolling() or package.is_upstream_rolling() or not package.found_upstream:
+            continue
+        if package.upstream_version and package.is_newer_than_upstream():
+            newer_than_upstream.rows.append(row)
+
+    return [newly_out_of_date, upstream_updated, locally_updated, new, removed, out_of_date, maintainerless,
+            newer_than_upstream]
 
 
 def pdf_add_new_page(pdf: ReportPDF, heading: str | None = None):
@@ -373,8 +947,69 @@ def pdf_add_new_page(pdf: ReportPDF, heading: str | None = None):
     pdf.set_font("helvetica", size=12)
 
 
-def print_report_pdf(current_distro_status: DistroPackageStatus, diff: DistroPackageStatusDiff | None, last_checks: []):
-    filename = date.today().strftime("report-%d-%m-%Y-%I-%M-%f.pdf")
+# Write a table with a bold heading row, which is repeated on every page.
+# The rows are written out as they come, instead of being collected by pdf.table() first, which lays out every cell
+# twice and is by far the slowest part of generating the report.
+def pdf_add_table(pdf: ReportPDF, columns: [str], rows):
+    width = pdf.epw / len(columns)
+    line_height = 2 * pdf.font_size
+    font_family, font_size = pdf.font_family, pdf.font_size_pt
+
+    def write_row(cells: [str], style: str = ""):
+        pdf.set_font(font_family, style, font_size)
+        # Nearly all cells fit on a single line, and do not need to be broken into lines
+        lines = [[cell] if pdf.get_string_width(cell) <= width - 2 * pdf.c_margin
+                 else pdf.multi_cell(width, line_height, cell, dry_run=True, output="LINES") for cell in cells]
+        height = line_height * max(len(cell_lines) for cell_lines in lines)
+        if style != "B" and pdf.will_page_break(height):
+            pdf.add_page()
+            write_row(columns, "B")
+            pdf.set_font(font_family, style, font_size)
+
+        x, y = pdf.get_x(), pdf.get_y()
+        for cell_lines in lines:
+            if height == line_height:
+                pdf.set_xy(x, y)
+                pdf.cell(width, line_height, cell_lines[0], border=1)
+            else:
+                # Border around the whole row height, with the text centered vertically
+                pdf.rect(x, y, width, height)
+                pdf.set_xy(x, y + (height - len(cell_lines) * line_height) / 2)
+                pdf.multi_cell(width, line_height, "\n".join(cell_lines))
+            x += width
+        pdf.set_xy(pdf.l_margin, y + height)
+
+    write_row(columns, "B")
+    for row in rows:
+        write_row([str(cell) for cell in row])
+
+
+# Part of the hash of stored reports. Increase it when the output of the renderers changes, so that reports stored
+# before are not reused.
+REPORT_RENDER_VERSION = 1
+
+
+# Everything shown in a report. It is computed once, and then rendered into each of the report formats.
+@dataclass
+class ReportModel:
+    date: str
+    package_count: int
+    out_of_date_count: int
+    # Date, amount of out of date packages and amount of packages of the last checks
+    last_checks: [[str]]
+    sections: [ReportSection]
+
+
+def build_report_model(current_distro_status: DistroPackageStatus, diff: DistroPackageStatusDiff | None,
+                       last_checks: []) -> ReportModel:
+    return ReportModel(date=date.today().strftime("%d/%m/%Y"),
+                       package_count=len(current_distro_status.packages),
+                       out_of_date_count=current_distro_status.countOutOfDate(),
+                       last_checks=[list(check) for check in last_checks] if last_checks is not None else [],
+                       sections=get_report_sections(current_distro_status, diff))
+
+
+def render_report_pdf(report: ReportModel) -> bytes:
     pdf = ReportPDF()
     pdf.alias_nb_pages()
 
@@ -385,184 +1020,106 @@ def print_report_pdf(current_distro_status: DistroPackageStatus, diff: DistroPac
     pdf.set_font("helvetica", size=20)
     pdf.cell(0, 15, "Summary", 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
     pdf.set_font("helvetica", size=12)
-    pdf.cell(0, 10, "Total amount of known packages: {}".format(len(current_distro_status.packages)), 1,
+    pdf.cell(0, 10, "Total amount of known packages: {}".format(report.package_count), 1,
              new_x=XPos.LMARGIN,
              new_y=YPos.NEXT)
-    pdf.cell(0, 10, "Total amount of out of date packages: {}".format(current_distro_status.countOutOfDate()), 1,
+    pdf.cell(0, 10, "Total amount of out of date packages: {}".format(report.out_of_date_count), 1,
              new_x=XPos.LMARGIN,
              new_y=YPos.NEXT)
-    if last_checks is not None and len(last_checks):
-        with pdf.table() as table:
-            index_row = table.row()
-            index_row.cell("Last check")
-            index_row.cell("Amount Out of Date")
-            index_row.cell("Amount of packages")
-            for check in last_checks:
-                row = table.row()
-                for cell in check:
-                    row.cell(str(cell))
-
-    if diff is not None:
-        # Print page for packages which have gotten out of date
-        if len(diff.newly_out_of_date_packages):
-            pdf_add_new_page(pdf, "Newly out of date")
-            pdf.cell(0, 10, "The following packages have gotten out of date:", 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-            with pdf.table() as table:
-                index_row = table.row()
-                index_row.cell("Package Name")
-                index_row.cell("Local Version")
-                index_row.cell("Upstream Version")
-                for name in diff.newly_out_of_date_packages:
-                    row = table.row()
-                    row.cell(name)
-                    package = current_distro_status.getPackage(name)
-                    if package is None:
-                        row.cell("Error getting package information: getPackage() returned None")
-                    else:
-                        row.cell(package.version)
-                        row.cell(package.upstream_version)
-
-        if len(diff.upstream_updated_packages):
-            pdf_add_new_page(pdf, "Updated upstream")
-            pdf.cell(0, 10, "The following packages have been updated upstream:", 0, new_x=XPos.LMARGIN,
-                     new_y=YPos.NEXT)
-            with pdf.table() as table:
-                index_row = table.row()
-                index_row.cell("Package Name")
-                index_row.cell("Local Version")
-                index_row.cell("Upstream Version")
-                for name in diff.upstream_updated_packages:
-                    row = table.row()
-                    row.cell(name)
-                    package = current_distro_status.getPackage(name)
-                    if package is None:
-                        row.cell("Error getting package information: getPackage() returned None")
-                    else:
-                        row.cell(package.version)
-                        row.cell(package.upstream_version)
-
-        if len(diff.locally_updated_packages):
-            pdf_add_new_page(pdf, "Updated locally")
-            pdf.cell(0, 10, "The following packages have been updated locally:", 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-            with pdf.table() as table:
-                index_row = table.row()
-                index_row.cell("Package Name")
-                index_row.cell("Local Version")
-                index_row.cell("Upstream Version")
-                for name in diff.locally_updated_packages:
-                    row = table.row()
-                    row.cell(name)
-                    package = current_distro_status.getPackage(name)
-                    if package is None:
-                        row.cell("Error getting package information: getPackage() returned None")
-                    else:
-                        row.cell(package.version)
-                        row.cell(package.upstream_version)
-
-        if len(diff.new_packages):
-            pdf_add_new_page(pdf, "New packages")
-            pdf.cell(0, 10, "The following packages have been added:", 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-            with pdf.table() as table:
-                index_row = table.row()
-                index_row.cell("Package Name")
-                index_row.cell("Local Version")
-                index_row.cell("Upstream Version")
-                for name in diff.new_packages:
-                    row = table.row()
-                    row.cell(name)
-                    package = current_distro_status.getPackage(name)
-                    if package is None:
-                        row.cell("Error getting package information: getPackage() returned None")
-                    else:
-                        row.cell(package.version)
-                        row.cell(package.upstream_version)
-
-        if len(diff.removed_packages):
-            pdf_add_new_page(pdf, "Removed packages")
-            pdf.cell(0, 10, "The following packages have been removed from reporting\n(either they are no longer"
-                            "available as packages, or they have been added to the ignore list):", 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-            with pdf.table() as table:
-                index_row = table.row()
-                index_row.cell("Package Name")
-                for name in diff.removed_packages:
-                    row = table.row()
-                    row.cell(name)
-
-    out_of_date_packages = current_distro_status.getOutOfDatePackages()
-    if len(out_of_date_packages):
-        pdf_add_new_page(pdf, "Out of date packages")
-        pdf.cell(0, 10, "In total, the following packages are out of date:", 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-        with pdf.table() as table:
-            index_row = table.row()
-            index_row.cell("Package Name")
-            index_row.cell("Local Version")
-            index_row.cell("Upstream Version")
-            for package in out_of_date_packages:
-                row = table.row()
-                row.cell(package.package)
-                row.cell(package.version)
-                row.cell(package.upstream_version)
-
-    # Generate a list of maintainerless and newer-than-upstream packages and print it as well
-    maintainerless_packages: [DistroPackage] = []
-    newer_than_upstream: [DistroPackage] = []
-    for distro_package in distro.packages:
-        package = current_distro_status.getPackage(distro_package.name)
-        if package is None:
-            continue
-        if distro_package.metadata.maintainer is None or not distro_package.metadata.maintainer:
-            maintainerless_packages.append(package)
-        if package.is_local_rolling() or package.is_upstream_rolling() or not package.found_upstream:
-            continue
-        if package.upstream_version and libversion.version_compare2(package.version, package.upstream_version) > 0:
-            newer_than_upstream.append(package)
-
-    if len(maintainerless_packages):
-        pdf_add_new_page(pdf, "Packages without maintainers")
-        pdf.cell(0, 10, "In total, the following packages have no defined maintainer:", 0, new_x=XPos.LMARGIN,
-                 new_y=YPos.NEXT)
-        with pdf.table() as table:
-            index_row = table.row()
-            index_row.cell("Package Name")
-            index_row.cell("Local Version")
-            index_row.cell("Upstream Version")
-            for package in maintainerless_packages:
-                row = table.row()
-                row.cell(package.package)
-                row.cell(package.version)
-                row.cell(package.upstream_version)
-
-    if len(newer_than_upstream):
-        pdf_add_new_page(pdf, "Packages newer than known upstream versions")
-        pdf.cell(0, 10, "In total, the following packages are newer than any known upstream version:", 0,
-                 new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-        with pdf.table() as table:
-            index_row = table.row()
-            index_row.cell("Package Name")
-            index_row.cell("Local Version")
-            index_row.cell("Upstream Version")
-            for package in newer_than_upstream:
-                row = table.row()
-                row.cell(package.package)
-                row.cell(package.version)
-                row.cell(package.upstream_version)
-
-    pdf.output(filename)
-    # Symlink the file to "latest-report.pdf"
-    if os.path.exists("latest-report.pdf"):
-        os.remove("latest-report.pdf")
-    os.symlink(filename, "latest-report.pdf")
-
-
-# Generate the generic report email.
-def generate_report_email(report_file: MIMEBase, recipient: str) -> MIMEMultipart:
-    message = MIMEMultipart()
-    message["From"] = smtp_email_address
-    message["Subject"] = date.today().strftime("{} package report for %d/%m/%Y".format(distro_name))
-    message["To"] = recipient
-    message["Bcc"] = recipient
-
-    # Generate message body
+    if len(report.last_checks):
+        pdf_add_table(pdf, ["Last check", "Amount Out of Date", "Amount of packages"], report.last_checks)
+
+    for section in report.sections:
+        if len(section.rows):
+            pdf_add_new_page(pdf, section.heading)
+            pdf.multi_cell(0, 10, section.description, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+            pdf_add_table(pdf, section.columns, section.rows)
+
+    return bytes(pdf.output())
+
+
+# A static page, which does not depend on the web server
+def render_report_html(report: ReportModel) -> bytes:
+    environment = Environment(loader=FileSystemLoader("web-files/templates"), autoescape=True)
+    return environment.get_template("report.html").render(distro_name=distro_name, report=report).encode()
+
+
+def render_report_json(report: ReportModel) -> bytes:
+    return json.dumps(dict(distro_name=distro_name, **asdict(report)), indent=4).encode()
+
+
+# All sections in a single table, with the section as the first column
+def render_report_csv(report: ReportModel) -> bytes:
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["Section", "Package Name", "Local Version", "Upstream Version"])
+    for section in report.sections:
+        for row in section.rows:
+            writer.writerow([section.heading, *row])
+    return output.getvalue().encode()
+
+
+# Format -> (renderer, MIME type)
+report_renderers: {str: (callable, str)} = {
+    "pdf": (render_report_pdf, "application/pdf"),
+    "html": (render_report_html, "text/html"),
+    "json": (render_report_json, "application/json"),
+    "csv": (render_report_csv, "text/csv"),
+}
+
+
+# Store the report in every format, named by the hash of the report model.
+# A report that has been stored before is reused instead of being rendered again.
+# This does not touch the database, so that it does not have to be locked while rendering; the files are recorded
+# with record_reports().
+# Returns the hash of the report, and the file of each format.
+def store_reports(report: ReportModel) -> tuple:
+    report_hash = hashlib.sha256(json.dumps([REPORT_RENDER_VERSION, distro_name, asdict(report)],
+                                            sort_keys=True).encode()).hexdigest()
+    os.makedirs(report_dir, exist_ok=True)
+    files: {str: str} = {}
+    for report_format in report_formats:
+        file = os.path.join(report_dir, "{}.{}".format(report_hash, report_format))
+        if not os.path.exists(file):
+            write_file_atomically(file, report_renderers[report_format][0](report))
+        else:
+            print("Reusing stored {} report {}".format(report_format, report_hash))
+        files[report_format] = file
+    return report_hash, files
+
+
+# Record the reports stored for a check, and expire old ones.
+# Returns the files of the expired reports, which may only be deleted once this has been committed.
+def record_reports(c: sqlite3.Cursor, report_hash: str, files: {str: str}, timestamp: int) -> [str]:
+    for report_format, file in files.items():
+        c.execute("INSERT INTO report_artifacts(hash, format, file, size, unix_timestamp) VALUES(?, ?, ?, ?, ?) "
+                  "ON CONFLICT(hash, format) DO UPDATE SET unix_timestamp = excluded.unix_timestamp",
+                  [report_hash, report_format, file, os.path.getsize(file), timestamp])
+    return remove_old_reports(c, reports_retained)
+
+
+# Drop all but the `keep` most recently produced reports from the database, and return their files.
+# Reports still attached to a queued email are kept until it has been sent.
+def remove_old_reports(c: sqlite3.Cursor, keep: int) -> [str]:
+    c.execute("SELECT hash FROM (SELECT hash FROM report_artifacts GROUP BY hash ORDER BY MAX(unix_timestamp) DESC "
+              "LIMIT -1 OFFSET ?) WHERE hash NOT IN (SELECT hash FROM report_artifacts WHERE file IN "
+              "(SELECT attachment FROM mail_outbox WHERE state = 'pending'))", [keep])
+    files: [str] = []
+    for report_hash, in c.fetchall():
+        c.execute("SELECT file FROM report_artifacts WHERE hash = ?", [report_hash])
+        files += [file for file, in c.fetchall()]
+        c.execute("DELETE FROM report_artifacts WHERE hash = ?", [report_hash])
+    return files
+
+
+def delete_report_files(files: [str]):
+    for file in files:
+        if os.path.exists(file):
+            os.remove(file)
+
+
+# Body of the generic report email.
+def generate_report_email(recipient: str) -> str:
     body = "The latest package report for {} has been generated.\n" \
         .format(distro_name)
     if message_unsubscribe_contact:
@@ -570,25 +1127,15 @@ def generate_report_email(report_file: MIMEBase, recipient: str) -> MIMEMultipar
             body += message_unsubscribe_contact.format(recipient)
         else:
             body += message_unsubscribe_contact
-    message.attach(MIMEText(body, "plain"))
-
-    # Attach PDF file
-    message.attach(report_file)
-
-    return message
+    return body
 
 
-# Generate the maintainer email.
+# Body of the maintainer email.
 # We call this function for each maintainer, as a decent amount of stuff is randomized.
-def generate_maintainer_email(report_file: MIMEBase, package_list: [str]) -> MIMEMultipart:
-    message = MIMEMultipart()
-    message["From"] = smtp_email_address
-    message["Subject"] = date.today().strftime("{} package report for %d/%m/%Y".format(distro_name))
-
-    # Generate message body
-    body = "{} package{}, for which you are listed as the maintainer, {} become out of date.\n" \
+def generate_maintainer_email(package_list: [str]) -> str:
+    return "{} package{}, for which you are listed as the maintainer, {} become out of date.\n" \
            "The packages are:{}\n" \
-           "See the package report PDF for more information and a full overview of the packages.\n\n" \
+           "See the attached package report for more information and a full overview of the packages.\n\n" \
            "You are receiving this email as you are listed as a package maintainer.\n" \
            "If you wish to no longer receive these emails, please submit a PR to " \
            "{} to remove yourself as maintainer." \
@@ -597,61 +1144,50 @@ def generate_maintainer_email(report_file: MIMEBase, package_list: [str]) -> MIM
                 "have" if len(package_list) != 1 else "has",
                 "\n\t".join(["", *package_list]),
                 repo_url)
-    message.attach(MIMEText(body, "plain"))
-
-    # Attach PDF file
-    message.attach(report_file)
-
-    return message
 
 
-def generate_maintainerless_email(report_file: MIMEBase, package_list: [str]) -> MIMEMultipart:
-    message = MIMEMultipart()
-    message["From"] = smtp_email_address
-    message["Subject"] = date.today().strftime("{} package report for %d/%m/%Y".format(distro_name))
-
-    # Generate message body
-    body = "{} package{}, which have no maintainers, {} become out of date.\n" \
+def generate_maintainerless_email(package_list: [str]) -> str:
+    return "{} package{}, which have no maintainers, {} become out of date.\n" \
            "The packages are:{}\n" \
-           "See the package report PDF for more information and a full overview of the packages.\n\n" \
+           "See the attached package report for more information and a full overview of the packages.\n\n" \
            "You are receiving this email as you are listed as a package maintainer.\n" \
            "If you wish to no longer receive these emails, contact the host of the package reporter. " \
         .format(len(package_list),
                 "s" if len(package_list) != 1 else "",
                 "have" if len(package_list) != 1 else "has",
                 "\n\t".join(["", *package_list]))
-    message.attach(MIMEText(body, "plain"))
 
-    # Attach PDF file
-    message.attach(report_file)
 
-    return message
+### Mail outbox
+# Emails are not sent right away, but put into the mail_outbox table along with the check.
+# deliver_outbox() then sends them over several SMTP connections, and retries failed ones with an increasing delay.
+# If it is interrupted, "main.py send-outbox" continues where it left off.
+def create_mail_outbox_table(c: sqlite3.Cursor):
+    c.execute("CREATE TABLE IF NOT EXISTS mail_outbox(id INTEGER PRIMARY KEY, unix_timestamp INT, recipient CHAR, "
+              "subject CHAR, body CHAR, attachment CHAR, attachment_format CHAR, state CHAR, attempts INT, "
+              "next_attempt INT, last_error CHAR, sent_timestamp INT)")
+    c.execute("CREATE INDEX IF NOT EXISTS mail_outbox_state ON mail_outbox(state, next_attempt)")
 
 
-# Send all the mails
-# Assumes file "latest-report.pdf" is present.
-def send_mails(c: sqlite3.Cursor, server: smtplib.SMTP_SSL | smtplib.SMTP, diff: DistroPackageStatusDiff | None,
-               current_distro_status: DistroPackageStatus):
-    c.execute("SELECT email FROM generic_email_recipients")
-    recipients = c.fetchall()
+def queue_mail(c: sqlite3.Cursor, recipient: str, body: str, attachment: str | None):
+    c.execute("INSERT INTO mail_outbox(unix_timestamp, recipient, subject, body, attachment, attachment_format, "
+              "state, attempts, next_attempt) VALUES(?, ?, ?, ?, ?, ?, 'pending', 0, 0)",
+              [int(time.time()), recipient,
+               date.today().strftime("{} package report for %d/%m/%Y".format(distro_name)), body,
+               attachment, email_report_format])
 
-    # Read report PDF file and encode it for mails
-    report_file: MIMEBase = MIMEBase("application", "octet-stream")
-    with open("latest-report.pdf", "rb") as file:
-        report_file.set_payload(file.read())
-    encoders.encode_base64(report_file)
-    report_file.add_header("Content-Disposition", "attachment; filename=latest-report.pdf")
 
+# Queue all the mails, with the report file `report_file` attached
+def queue_mails(c: sqlite3.Cursor, diff: DistroPackageStatusDiff | None, current_distro_status: DistroPackageStatus,
+                report_file: str):
     # Generate the email
     if send_generic_email:
-        print("Sending generic emails")
-        for recipient in recipients:
+        c.execute("SELECT email FROM generic_email_recipients")
+        for recipient in c.fetchall():
             recipient = recipient[0]
-            customized_mail = generate_report_email(report_file, recipient)
-            server.sendmail(smtp_email_address, recipient, customized_mail.as_string())
+            queue_mail(c, recipient, generate_report_email(recipient), report_file)
 
     if send_maintainer_email and diff is not None:
-        print("Sending maintainer emails")
         maintainers_package_list: dict = dict()
         maintainerless_packages: [] = []
         # Check the package list
@@ -674,56 +1210,226 @@ def send_mails(c: sqlite3.Cursor, server: smtplib.SMTP_SSL | smtplib.SMTP, diff:
                 else:
                     maintainers_package_list[email_addr[1]] = [package_string]
 
-        # Now send the mails
         for maintainer in maintainers_package_list.keys():
-            message = generate_maintainer_email(report_file, maintainers_package_list[maintainer])
-            message["To"] = maintainer
-            message["Bcc"] = maintainer
-            server.sendmail(smtp_email_address, maintainer, message.as_string())
+            queue_mail(c, maintainer, generate_maintainer_email(maintainers_package_list[maintainer]), report_file)
 
         # If there are packages with no maintainer, send it to a fallback if present
         if len(maintainerless_packages) and no_maintainer_fallback_email:
-            message = generate_maintainerless_email(report_file, maintainerless_packages)
-            message["To"] = no_maintainer_fallback_email
-            message["Bcc"] = no_maintainer_fallback_email
-            server.sendmail(smtp_email_address, no_maintainer_fallback_email, message.as_string())
+            queue_mail(c, no_maintainer_fallback_email, generate_maintainerless_email(maintainerless_packages),
+                       report_file)
 
 
-def main():
-    database = sqlite3.connect("packages.db")
-    perform_init()
+# smtplib only fixes line endings of str messages, so messages are serialized with CRLF already
+mail_policy = compat32.clone(linesep="\r\n")
 
-    if maintain_xbdistro_sqllite_database:
+
+# The report attached to the emails is the same for every recipient, so its MIME part is only encoded once.
+# Stored reports never change, so it can be kept by file name.
+@functools.lru_cache(maxsize=4)
+def get_serialized_attachment(attachment: str, attachment_format: str) -> bytes:
+    report_file: MIMEBase = MIMEBase(*report_renderers[attachment_format][1].split("/"))
+    with open(attachment, "rb") as file:
+        report_file.set_payload(file.read())
+    encoders.encode_base64(report_file)
+    report_file.add_header("Content-Disposition",
+                           "attachment; filename=latest-report.{}".format(attachment_format))
+    return report_file.as_bytes(policy=mail_policy)
+
+
+def build_outbox_message(recipient: str, subject: str, body: str, attachment: str | None,
+                         attachment_format: str) -> bytes:
+    message = MIMEMultipart()
+    message["From"] = smtp_email_address
+    message["Subject"] = subject
+    message["To"] = recipient
+    message.attach(MIMEText(body, "plain"))
+    if attachment is None:
+        return message.as_bytes(policy=mail_policy)
+
+    # Only serialize the headers and the text part, and put the encoded attachment in front of the closing boundary.
+    # The boundary can not show up in the base64 encoded attachment, only the body has to be checked.
+    attachment_data = get_serialized_attachment(attachment, attachment_format)
+    boundary = "=" * 15 + secrets.token_hex(16) + "=="
+    while boundary in body:
+        boundary = "=" * 15 + secrets.token_hex(16) + "=="
+    message.set_boundary(boundary)
+    data = message.as_bytes(policy=mail_policy)
+    closing_boundary = data.rindex("--{}--".format(boundary).encode())
+    return b"".join([data[:closing_boundary], "--{}\r\n".format(boundary).encode(), attachment_data, b"\r\n",
+                     data[closing_boundary:]])
+
+
+# Every delivery thread keeps its own SMTP connection open
+smtp_thread_state = local()
+smtp_servers: [smtplib.SMTP] = []
+smtp_servers_lock: Lock = Lock()
+
+
+def get_smtp_server() -> smtplib.SMTP:
+    if getattr(smtp_thread_state, "server", None) is None:
+        server = smtplib.SMTP(smtp_host, smtp_port)
+        if smtp_is_secure:
+            server.ehlo()
+            server.starttls(context=ssl_context)
+            server.ehlo()
+        if smtp_do_auth:
+            server.login(smtp_login_user, smtp_login_password)
+        smtp_thread_state.server = server
+        with smtp_servers_lock:
+            smtp_servers.append(server)
+    return smtp_thread_state.server
+
+
+# Drop the SMTP connection of this thread, so that a new one is opened for the next mail
+def reset_smtp_server():
+    server = getattr(smtp_thread_state, "server", None)
+    smtp_thread_state.server = None
+    if server is not None:
+        try:
+            server.close()
+        except OSError:
+            pass
+
+
+# Deliver a single mail from the outbox.
+# Returns None if it was sent, or the error and whether it is worth retrying.
+def deliver_mail(mail: tuple) -> tuple | None:
+    mail_id, recipient, subject, body, attachment, attachment_format = mail
+    try:
+        message = build_outbox_message(recipient, subject, body, attachment, attachment_format)
+    except OSError as e:
+        # The attachment is gone, this will not get any better
+        return "Failed to read attachment: {}".format(e), False
+    try:
+        get_smtp_server().sendmail(smtp_email_address, recipient, message)
+    except smtplib.SMTPRecipientsRefused as e:
+        # Only 5xx replies are permanent, 4xx ones (e.g. greylisting) are worth retrying.
+        # On 421 the server has closed the connection as well.
+        if all(500 <= code < 600 for code, message in e.recipients.values()):
+            return "Recipient refused: {}".format(e.recipients), False
+        reset_smtp_server()
+        return "Recipient temporarily refused: {}".format(e.recipients), True
+    except (smtplib.SMTPException, OSError) as e:
+        # The connection might be broken, so open a new one for the next mail
+        reset_smtp_server()
+        return "{}: {}".format(type(e).__name__, e), True
+    return None
+
+
+# Send all due mails in the outbox, until there are none left that can be retried
+def deliver_outbox(database: sqlite3.Connection):
+    sent, failed = 0, 0
+    with ThreadPoolExecutor(max_workers=smtp_connections) as pool:
+        while True:
+            with closing(database.cursor()) as c:
+                c.execute("SELECT MIN(next_attempt) FROM mail_outbox WHERE state = 'pending'")
+                next_attempt = c.fetchone()[0]
+                if next_attempt is None:
+                    break
+                if next_attempt > time.time():
+                    print("Waiting {:.0f}s to retry sending emails".format(next_attempt - time.time()))
+                    time.sleep(max(0.0, next_attempt - time.time()))
+                c.execute("SELECT id, recipient, subject, body, attachment, attachment_format FROM mail_outbox "
+                          "WHERE state = 'pending' AND next_attempt <= ?", [time.time()])
+                mails = c.fetchall()
+
+            futures = {pool.submit(deliver_mail, mail): mail[0] for mail in mails}
+            for future in as_completed(futures):
+                result = future.result()
+                # Record each result right away, so that nothing is sent twice if we are interrupted
+                with closing(database.cursor()) as c:
+                    if result is None:
+                        sent += 1
+                        c.execute("UPDATE mail_outbox SET state = 'sent', attempts = attempts + 1, last_error = NULL, "
+                                  "sent_timestamp = ? WHERE id = ?", [int(time.time()), futures[future]])
+                    else:
+                        error, retry = result
+                        c.execute("SELECT attempts FROM mail_outbox WHERE id = ?", [futures[future]])
+                        attempts = c.fetchone()[0] + 1
+                        if not retry or attempts >= mail_max_attempts:
+                            failed += 1
+                            print("Failed to send email {}: {}".format(futures[future], error))
+                            c.execute("UPDATE mail_outbox SET state = 'failed', attempts = ?, last_error = ? "
+                                      "WHERE id = ?", [attempts, error, futures[future]])
+                        else:
+                            c.execute("UPDATE mail_outbox SET attempts = ?, last_error = ?, next_attempt = ? "
+                                      "WHERE id = ?",
+                                      [attempts, error, time.time() + mail_retry_delay * 2 ** (attempts - 1),
+                                       futures[future]])
+                database.commit()
+
+    with smtp_servers_lock:
+        for server in smtp_servers:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+        smtp_servers.clear()
+    print("Sent {} emails, {} failed".format(sent, failed))
+
+
+def main():
+    # Checked before anything is done, instead of failing while saving the check
+    if send_emails and email_report_format not in report_formats:
+        raise ValueError("email_report_format '{}' is not one of the report_formats {}"
+                         .format(email_report_format, report_formats))
+    database = connect_packages_database("packages.db", database_busy_timeout)
+    # If the distro has not changed, the xbdistro database is still up to date as well.
+    # It can only be created from a fully parsed distro though, so don't use the cache if it is missing.
+    distro_cached = perform_init(not maintain_xbdistro_sqllite_database or os.path.exists("xbdistro.db"))
+
+    if maintain_xbdistro_sqllite_database and not distro_cached:
         print("Creating XBDistro Tool SQLite database")
         xbdistro_sql = XBStrapSQLite.XBStrapSQLite(distro, "xbdistro.db")
         xbdistro_sql.update_database()
+    if maintain_xbdistro_sqllite_database:
+        with closing(sqlite3.connect("xbdistro.db")) as xbdistro_database:
+            with closing(xbdistro_database.cursor()) as c:
+                create_xbdistro_indexes(c)
+            xbdistro_database.commit()
+    # Only now, as a cached distro skips the xbdistro database update
+    if not distro_cached:
+        save_distro_cache(distro_cache_key, distro)
 
     with closing(database.cursor()) as c:
         perform_db_init(c)
+    database.commit()
 
     print("Reading foreign repositories")
-    foreign_repositories.append(NixOSRepository(database.cursor(), "unstable"))
+    with closing(database.cursor()) as c:
+        load_foreign_repositories(c)
+
+    # Check if we have the previous one (aka check if we have run before)
+    previous_check: DistroPackageStatus | None = None
+    changed_files: set[str] | None = None
+    previous_records: dict | None = None
+    with closing(database.cursor()) as c:
+        previous_timestamp = get_latest_snapshot_timestamp(c)
+        if previous_timestamp is not None:
+            previous_check = DistroPackageStatus.fromSnapshot(c, previous_timestamp)
+            if incremental_checks:
+                changed_files = get_changed_files_since(c, previous_timestamp)
+                previous_records = load_upstream_records(c, previous_timestamp)
 
     print("Creating current distro status")
-    current_distro_status: DistroPackageStatus = DistroPackageStatus(distro)
+    current_distro_status: DistroPackageStatus = DistroPackageStatus(distro, previous_check, changed_files,
+                                                                     previous_records)
     # pprint(current_distro_status)
     # print(current_distro_status.toJSON())
 
-    # Check if we have the previous one (aka check if we have run before)
-    # If we do not, treat the current status as the diff
+    # If we have not run before, treat the current status as the diff
     diff: DistroPackageStatusDiff | None = None
-    with closing(database.cursor()) as c:
-        c.execute("SELECT json_distro_state_b64 FROM previous_check_json ORDER BY unix_timestamp DESC LIMIT 1")
-        base64_encoded = c.fetchone()
-        if base64_encoded is not None:
-            previous_check = DistroPackageStatus.fromJSON(base64.b64decode(base64_encoded[0]))
-            diff = DistroPackageStatusDiff(current_distro_status, previous_check)
+    if previous_check is not None:
+        diff = DistroPackageStatusDiff(current_distro_status, previous_check)
     pprint(diff)
 
     with closing(database.cursor()) as c:
         c.execute("SELECT last_check, amount_ood, amount FROM check_metadata ORDER BY unix_timestamp DESC LIMIT 5")
-        print_report_pdf(current_distro_status, diff, c.fetchall())
+        report = build_report_model(current_distro_status, diff, c.fetchall())
+    # Rendered before the check is saved, so that the database is not locked for writing while doing so
+    report_hash, report_files = store_reports(report)
 
+    # Everything is only written from here on, and committed at once
     with closing(database.cursor()) as c:
         timestamp: int = int(time.time())
         c.execute("INSERT INTO check_metadata(last_check, amount_ood, amount, unix_timestamp) VALUES "
@@ -732,27 +1438,68 @@ def main():
                                               len(current_distro_status.packages),
                                               timestamp))
 
-        # Add this check into the check history table
-        base64_encoded: str = base64.b64encode(current_distro_status.toJSON().encode()).decode()
-        # print(base64_encoded)
-        c.execute("INSERT INTO previous_check_json(unix_timestamp, json_distro_state_b64) VALUES('{}', '{}')".format(
-            timestamp,
-            base64_encoded))
+        # Add this check into the check history
+        save_snapshot(c, timestamp, current_distro_status.packages, history_keyframe_interval)
+        # Remember what this check was based on, for the next incremental check
+        c.execute("INSERT INTO check_state(unix_timestamp, commit_sha, rules_hash, repositories) VALUES(?, ?, ?, ?)",
+                  [timestamp, distro_commit, get_rules_hash(),
+                   json.dumps(sorted(repo.get_repo_name() for repo in foreign_repositories))])
+        save_upstream_records(c, timestamp, [package.package for package in current_distro_status.packages])
+        for repo in foreign_repositories:
+            repo.save_changes(c)
+        expired_report_files = record_reports(c, report_hash, report_files, timestamp)
+        # Queued along with the check, so that they can still be sent if we get interrupted
+        if send_emails:
+            queue_mails(c, diff, current_distro_status, report_files[email_report_format])
+
+    # Publish the prebuilt responses before committing, so they exist as soon as the web server sees the new check
+    publish_package_list(published_dir, timestamp, current_distro_status.packages,
+                         current_distro_status.countOutOfDate(), list(report_files))
+    remove_old_published(published_dir, published_checks_retained)
 
     database.commit()
+    for repo in foreign_repositories:
+        repo.finish_update()
+    delete_report_files(expired_report_files)
 
     # Now do the mail sending, if needed
     if send_emails:
-        with closing(database.cursor()) as c:
-            with smtplib.SMTP(smtp_host, smtp_port) as server:
-                if smtp_is_secure:
-                    server.ehlo()
-                    server.starttls(context=ssl_context)
-                    server.ehlo()
-                if smtp_do_auth:
-                    server.login(smtp_login_user, smtp_login_password)
-                send_mails(c, server, diff, current_distro_status)
+        deliver_outbox(database)
+
+    print_repository_timings()
+
+
+# Apply the retention policy to the check history, and re-encode it
+def compact(keep_days: int | None):
+    database = connect_packages_database("packages.db", database_busy_timeout)
+    with closing(database.cursor()) as c:
+        perform_db_init(c)
+        keep_since = int(time.time()) - keep_days * 24 * 60 * 60 if keep_days is not None else None
+        compact_snapshot_history(c, keep_since, history_keyframe_interval)
+    database.commit()
+    database.execute("VACUUM")
+
+
+def send_outbox():
+    database = connect_packages_database("packages.db", database_busy_timeout)
+    with closing(database.cursor()) as c:
+        perform_db_init(c)
+    database.commit()
+    deliver_outbox(database)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="{} package reporter".format(distro_name))
+    subparsers = parser.add_subparsers(dest="command")
+    compact_parser = subparsers.add_parser("compact", help="Drop old checks from the history and re-encode it")
+    compact_parser.add_argument("--keep-days", type=int, default=history_retention_days,
+                                help="Keep the checks of this many days")
+    subparsers.add_parser("send-outbox", help="Send the emails that are still queued, e.g. after an interrupted run")
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        compact(args.keep_days)
+    elif args.command == "send-outbox":
+        send_outbox()
+    else:
+        main()
@@ -1,12 +1,14 @@
-import base64
 from pprint import pprint
-from flask import Flask, json, jsonify, render_template, request, send_from_directory
+from flask import Flask, Response, json, jsonify, render_template, request, send_file
 from flask_caching import Cache
 from contextlib import closing
-from threading import Lock
+from functools import wraps
+from threading import Lock, local
+import os
 import sqlite3
-import libversion
 import json
+import base64
+from datetime import datetime
 
 # Random code generation
 import random
@@ -31,6 +33,25 @@ contact_email: str = "fillmein@test.com"
 server_url: str = "127.0.0.1:5000"
 # Name of distribution
 distro_name: str = "Managarm"
+# Directory of the prebuilt responses published by main.py. Must match published_dir in main.py.
+published_dir: str = "published"
+
+## Caching
+# Cache backend to use.
+# "SimpleCache" keeps cached responses and the latest snapshot in the memory of each worker process.
+# "FileSystemCache" keeps cached responses in cache_dir, where they are shared by all worker processes (e.g. when
+# running under gunicorn with several workers). The workers then do not each hold a copy of the latest snapshot.
+cache_type: str = "SimpleCache"
+cache_dir: str = "web-cache"
+# Maximum amount of cached responses. Entries are kept until a newer check appears, so this is the only limit.
+cache_threshold: int = 2000
+
+# Largest page of /api/packages/list that can be requested with the limit parameter
+package_list_max_limit: int = 1000
+
+## Databases
+# Seconds to wait for another writer (e.g. main.py saving a check) to finish before giving up on a write.
+database_busy_timeout: float = 30
 
 ## Send emails
 # Enable email related requests.
@@ -51,14 +72,46 @@ smtp_login_password: str = ""
 
 ### CODE
 app = Flask(__name__, static_folder="web-files/static", template_folder="web-files/templates")
-cache = Cache(app, config={"CACHE_TYPE": "SimpleCache"})
-
-database = sqlite3.connect("packages.db", check_same_thread=False)
-# We need to lock the database manually when we write
-database_write_lock: Lock = Lock()
-
-# We do not maintain a lock for this database since we do not write to it
-xbdistro_database = sqlite3.connect("xbdistro.db", check_same_thread=False)
+cache_config: dict = {"CACHE_TYPE": cache_type, "CACHE_DEFAULT_TIMEOUT": 0, "CACHE_THRESHOLD": cache_threshold}
+if cache_type == "FileSystemCache":
+    cache_config["CACHE_DIR"] = cache_dir
+cache = Cache(app, config=cache_config)
+# With a shared cache, single packages are read from the snapshot rows instead of a per-worker copy of the snapshot
+hold_previous_check: bool = cache_type == "SimpleCache"
+
+# Every thread gets its own connections, as they can not be shared between threads.
+# packages.db is in WAL mode, so readers are neither blocked by each other nor by main.py saving a check, and
+# writers wait for each other through the busy timeout.
+database_connections = local()
+
+
+def get_database() -> sqlite3.Connection:
+    if not hasattr(database_connections, "packages"):
+        database_connections.packages = connect_packages_database("packages.db", database_busy_timeout)
+    return database_connections.packages
+
+
+# xbdistro.db is only read by us, and recreated by main.py when the distro changes.
+# Reopen it when that happened, as we would otherwise keep reading the old file.
+def get_xbdistro_database() -> sqlite3.Connection:
+    file_id = os.stat("xbdistro.db").st_ino
+    if getattr(database_connections, "xbdistro_file_id", None) != file_id:
+        if hasattr(database_connections, "xbdistro"):
+            database_connections.xbdistro.close()
+        database_connections.xbdistro = connect_read_only_database("xbdistro.db", database_busy_timeout)
+        database_connections.xbdistro_file_id = file_id
+    return database_connections.xbdistro
+
+
+# Make sure the indexes used to look up extended package data exist, in case main.py has not created them yet.
+# If we may not write to xbdistro.db (or it does not exist yet), the lookups are just slower.
+try:
+    with closing(sqlite3.connect("file:xbdistro.db?mode=rw", uri=True)) as xbdistro_database:
+        with closing(xbdistro_database.cursor()) as c:
+            create_xbdistro_indexes(c)
+        xbdistro_database.commit()
+except sqlite3.Error as e:
+    print("Could not create the xbdistro database indexes: {}".format(e))
 
 ssl_context = ssl.create_default_context()
 
@@ -72,9 +125,17 @@ class DistroPackageStatus:
 
     def __init__(self):
         self.packages = []
+        # Package name -> package, for getPackage()
+        self.package_index = {}
 
     def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+        # The package index is not serialized, it is rebuilt by fromJSON()
+        return json.dumps(dict(packages=self.packages), default=lambda o: o.__dict__, sort_keys=True, indent=4)
+
+    def addPackage(self, package: DistroPackage):
+        self.packages.append(package)
+        # If a name shows up twice, keep returning the first one
+        self.package_index.setdefault(package.package, package)
 
     @staticmethod
     def fromJSON(json_data: str):
@@ -97,27 +158,32 @@ class DistroPackageStatus:
                                                    upstream_repo=package["upstream_repo"],
                                                    found_upstream=package["found_upstream"],
                                                    file=package["file"],
-                                                   line=package["line"])
-            ret.packages.append(package)
+                                                   line=str(package["line"]),
+                                                   upstream_compare=package.get("upstream_compare"))
+            ret.addPackage(package)
+        return ret
+
+    @staticmethod
+    def fromSnapshot(c: sqlite3.Cursor, timestamp: int):
+        ret: DistroPackageStatus = DistroPackageStatus()
+        for package in load_snapshot(c, timestamp):
+            ret.addPackage(package)
         return ret
 
     def countOutOfDate(self):
         result: int = 0
         for package in self.packages:
-            if libversion.version_compare2(package.version, package.upstream_version) < 0:
+            if package.is_out_of_date():
                 result += 1
         return result
 
     def getPackage(self, name: str) -> DistroPackage | None:
-        for package in self.packages:
-            if package.package == name:
-                return package
-        return None
+        return self.package_index.get(name)
 
     def getOutOfDatePackages(self) -> [DistroPackage]:
         ret: [DistroPackage] = []
         for package in self.packages:
-            if libversion.version_compare2(package.upstream_version, package.version) > 0:
+            if package.is_out_of_date():
                 ret.append(package)
         return ret
 
@@ -146,131 +212,224 @@ def generate_code():
 
 
 
-@cache.cached(timeout=10)
+### Caching
+# Everything shown by the web server only changes when a new check is saved, so instead of expiring entries after a
+# fixed time, they are kept for as long as the check they were built from is the latest one.
+# The latest check is found with a cheap lookup of the largest snapshot timestamp.
+cache_stats: dict = dict(snapshot_hits=0, snapshot_misses=0, response_hits=0, response_misses=0)
+cache_stats_lock: Lock = Lock()
+
+# The parsed snapshot of the latest check, along with its timestamp
+previous_check_timestamp: int | None = None
+previous_check: DistroPackageStatus | None = None
+previous_check_lock: Lock = Lock()
+
+
+def count_cache_access(name: str):
+    with cache_stats_lock:
+        cache_stats[name] += 1
+
+
+def get_latest_check_timestamp() -> int | None:
+    with closing(get_database().cursor()) as c:
+        return get_latest_snapshot_timestamp(c)
+
+
 def get_previous_check() -> DistroPackageStatus | None:
-    with closing(database.cursor()) as c:
-        # Not locked - Cannot issue writes
-        c.execute("SELECT json_distro_state_b64 FROM previous_check_json ORDER BY unix_timestamp DESC LIMIT 1")
-        base64_encoded = c.fetchone()
-        if base64_encoded is None:
-            return None
-        previous_check: DistroPackageStatus = DistroPackageStatus.fromJSON(base64.b64decode(base64_encoded[0]))
+    global previous_check_timestamp, previous_check
+    timestamp = get_latest_check_timestamp()
+    if timestamp is None:
+        return None
+    if previous_check_timestamp == timestamp:
+        count_cache_access("snapshot_hits")
         return previous_check
 
+    with previous_check_lock:
+        # Another request might have loaded it while we were waiting
+        if previous_check_timestamp == timestamp:
+            count_cache_access("snapshot_hits")
+            return previous_check
+        count_cache_access("snapshot_misses")
+        with closing(get_database().cursor()) as c:
+            check: DistroPackageStatus = DistroPackageStatus.fromSnapshot(c, timestamp)
+        previous_check, previous_check_timestamp = check, timestamp
+        return check
+
+
+# Get the state of a package in the check with the given timestamp, which should be the latest one
+def get_previous_check_package(timestamp: int, name: str) -> DistroPackage | None:
+    if not hold_previous_check:
+        with closing(get_database().cursor()) as c:
+            return load_snapshot_package(c, timestamp, name)
+
+    previous_check = get_previous_check()
+    if previous_check is None:
+        return None
+    return previous_check.getPackage(name)
+
+
+# Cache the result of a function until a newer check appears.
+# The timestamp of the latest check is part of the key, so older entries are never hit again and get evicted.
+def cached_per_check(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        key = "{}/{}/{}/{}".format(function.__name__, get_latest_check_timestamp(), args, sorted(kwargs.items()))
+        result = cache.get(key)
+        if result is not None:
+            count_cache_access("response_hits")
+            return result
+        count_cache_access("response_misses")
+        result = function(*args, **kwargs)
+        cache.set(key, result)
+        return result
+    return wrapper
+
+
+# Fetch the extended data of many packages from the xbdistro database at once.
+# Everything about a package is gathered by a single query, with the lists aggregated into JSON by SQLite.
+def get_extended_package_data_bulk(names: [str]) -> dict:
+    results: dict = dict()
+    with closing(get_xbdistro_database().cursor()) as c:
+        # Stay below the limit of bound parameters per statement
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            c.execute("SELECT p.name, p.source_name, p.revision, p.maintainer, s.source_name, s.version, "
+                      "(SELECT json_group_array(package_depend) FROM package_dependencies "
+                      "WHERE package_name = p.name), "
+                      "(SELECT json_group_array(package_name) FROM package_dependencies "
+                      "WHERE package_depend = p.name), "
+                      "(SELECT json_group_array(json_array(file, line, entry)) FROM file_lines "
+                      "WHERE package_name = p.name OR package_name = '__source__' || p.source_name) "
+                      "FROM packages p LEFT JOIN sources s ON s.source_name = p.source_name "
+                      "WHERE p.name IN ({})".format(", ".join("?" * len(chunk))), chunk)
+            for row in c.fetchall():
+                results[row[0]] = extended_package_data_from_row(row)
+
+    for name in names:
+        if name not in results:
+            results[name] = dict(status=500, message="Failed to find package in xbdistro database")
+    return results
+
+
+def extended_package_data_from_row(row) -> dict:
+    (name, source_name, revision, maintainer, found_source, source_version,
+     dependencies, dependent, xbdistro_line_info) = row
+    if found_source is None:
+        return dict(status=500, message="Failed to find source in xbdistro database")
+
+    xbdistro_line_info = json.loads(xbdistro_line_info)
+    if len(xbdistro_line_info) != 3:
+        return dict(status=500, message="Failed to find file line info in xbdistro database")
+    lines: dict = {entry: (file, line) for file, line, entry in xbdistro_line_info}
+    if "source_def" not in lines:
+        return dict(status=500, message="Failed to find source file line info in xbdistro database")
+    if "meta_def" not in lines:
+        return dict(status=500, message="Failed to find meta file line info in xbdistro database")
+    if "main_def" not in lines:
+        return dict(status=500, message="Failed to find main file line info in xbdistro database")
 
-@cache.memoize(30)
-def get_extended_package_data(name: str) -> dict:
-    print("get_extended_package_data({})".format(name))
-    with closing(xbdistro_database.cursor()) as c:
-        # Not locked - Cannot issue writes
-        c.execute("SELECT source_name, revision, maintainer FROM packages WHERE name = ?", [name])
-        xbdistro_package_data = c.fetchone()
-        if xbdistro_package_data is None:
-            return dict(status=500, message="Failed to find package in xbdistro database")
-        c.execute("SELECT type, version FROM sources WHERE source_name = ?", [xbdistro_package_data[0]])
-        xbdistro_source_data = c.fetchone()
-        if xbdistro_package_data is None:
-            return dict(status=500, message="Failed to find source in xbdistro database")
-
-        # Get the list of dependencies
-        c.execute("SELECT package_depend FROM package_dependencies WHERE package_name = ?", [name])
-        dependencies: [str] = []
-        for data in c.fetchall():
-            dependencies.append(data[0])
-
-        # Get the list of dependent packages
-        c.execute("SELECT package_name FROM package_dependencies WHERE package_depend = ?", [name])
-        dependent: [str] = []
-        for data in c.fetchall():
-            dependent.append(data[0])
-
-        # Get the needed information from the file_lines table
-        c.execute("SELECT file, line, entry FROM file_lines WHERE package_name = ? OR package_name = ?",
-                  [name, "__source__" + xbdistro_package_data[0]])
-        xbdistro_line_info = c.fetchall()
-        if xbdistro_line_info is None or len(xbdistro_line_info) != 3:
-            return dict(status=500, message="Failed to find file line info in xbdistro database")
-        for file_line_entry in xbdistro_line_info:
-            if file_line_entry[2] == "source_def":
-                source_line = file_line_entry
-            elif file_line_entry[2] == "meta_def":
-                meta_line = file_line_entry
-            elif file_line_entry[2] == "main_def":
-                main_line = file_line_entry
-        if "source_line" not in locals():
-            return dict(status=500, message="Failed to find source file line info in xbdistro database")
-        if "meta_line" not in locals():
-            return dict(status=500, message="Failed to find meta file line info in xbdistro database")
-        if "main_line" not in locals():
-            return dict(status=500, message="Failed to find main file line info in xbdistro database")
     return dict(status=200,
-                source=dict(name=xbdistro_package_data[0],
-                            version=xbdistro_source_data[1],
-                            file=source_line[0],
-                            line=source_line[1]),
-                revision=xbdistro_package_data[1],
-                metadata=dict(maintainer=xbdistro_package_data[2],
-                              file=meta_line[0],
-                              line=meta_line[1]),
-                dependencies=dependencies,
-                dependent=dependent,
-                file=main_line[0],
-                line=main_line[1])
+                source=dict(name=source_name,
+                            version=source_version,
+                            file=lines["source_def"][0],
+                            line=lines["source_def"][1]),
+                revision=revision,
+                metadata=dict(maintainer=maintainer,
+                              file=lines["meta_def"][0],
+                              line=lines["meta_def"][1]),
+                dependencies=json.loads(dependencies),
+                dependent=json.loads(dependent),
+                file=lines["main_def"][0],
+                line=lines["main_def"][1])
+
+
+@cached_per_check
+def get_extended_package_data(name: str) -> dict:
+    return get_extended_package_data_bulk([name])[name]
+
+
+# Raised when a write had to wait for another writer for longer than database_busy_timeout
+@app.errorhandler(sqlite3.OperationalError)
+def handle_database_error(error: sqlite3.OperationalError):
+    # Do not leave the thread's connection in the middle of a transaction
+    get_database().rollback()
+    if "locked" not in str(error):
+        raise error
+    return render_template("error.html", status=503, message="The database is busy, please try again later"), 503
+
+
+@app.template_filter("timestamp")
+def format_timestamp(unix_timestamp: int) -> str:
+    return datetime.fromtimestamp(unix_timestamp).strftime("%d/%m/%Y %H:%M")
+
+
+### Published responses
+# Returns the timestamp of the latest check and the path of one of its published files.
+# main.py publishes them with every check; if they are missing (e.g. for checks made before they were published),
+# they are created here from the snapshot.
+def get_published_file(filename: str) -> (int | None, str | None):
+    with closing(get_database().cursor()) as c:
+        timestamp = get_latest_snapshot_timestamp(c)
+        if timestamp is None:
+            return None, None
+        if not os.path.exists(get_published_path(published_dir, timestamp, "main_page.json")):
+            snapshot: DistroPackageStatus = DistroPackageStatus.fromSnapshot(c, timestamp)
+            publish_package_list(published_dir, timestamp, snapshot.packages, snapshot.countOutOfDate(),
+                                 get_report_artifact_formats(c, timestamp))
+
+    path = get_published_path(published_dir, timestamp, filename)
+    if filename == "main_page.html" and not os.path.exists(path):
+        # Only rendered once per check
+        with open(get_published_path(published_dir, timestamp, "main_page.json"), "r") as file:
+            main_page_data = json.load(file)
+        write_published_file(published_dir, timestamp, filename,
+                             render_template("main_page.html", distro_name=distro_name, **main_page_data).encode())
+    return timestamp, path
+
+
+# Send a published file, in the best precompressed variant the client accepts.
+# As the files never change once published, the ETag only depends on the check and the variant.
+def send_published_file(path: str, mimetype: str, etag: str):
+    content_encoding: str | None = None
+    for encoding, suffix in PUBLISHED_ENCODINGS.items():
+        if request.accept_encodings[encoding] and os.path.exists(path + suffix):
+            path += suffix
+            etag += "-" + encoding
+            content_encoding = encoding
+            break
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        # send_file resolves relative paths against the application root, not the working directory
+        response = send_file(os.path.abspath(path), mimetype=mimetype, conditional=False, etag=False)
+        if content_encoding is not None:
+            response.headers["Content-Encoding"] = content_encoding
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    return response
+
 
 ### Web UI
 @app.route("/")
-@cache.cached(timeout=120)
 def main_page():
-    previous_check = get_previous_check()
-    if previous_check is None:
+    timestamp, path = get_published_file("main_page.html")
+    if path is None:
         return render_template("error.html", status=500, message="Failed to find last check in database")
-
-    package_list: [] = []
-    for package in previous_check.packages:
-        package_dict: dict = dict(name=package.package,
-                                  version=package.version,
-                                  origin=dict(file=package.file, line=package.line))
-        if package.found_upstream:
-            package_dict["upstream_version"] = package.upstream_version
-            package_dict["upstream_repo"] = package.upstream_repo
-        # TODO: do we save this in the database?
-        #       at the moment we dont to save space, as the encoding isnt that great,
-        #       however depending on what the performance of this is ends up being, we might want to consider saving this
-        # Check if package is up to date
-        if package.found_upstream:
-            package_dict["is_up_to_date"] = True if libversion.version_compare2(package.version,
-                                                                                package.upstream_version) >= 0 else False
-        package_list.append(package_dict)
-
-    return render_template("main_page.html", distro_name=distro_name,
-                           package_count=len(previous_check.packages),
-                           count_out_of_date=len(previous_check.getOutOfDatePackages()),
-                           packages=sorted(package_list, key=lambda d: d["name"]))
+    return send_published_file(path, "text/html", "{}-main_page".format(timestamp))
 
 
 @app.route("/package/<name>")
-@cache.cached(timeout=60)
+@cached_per_check
 def package_info_page(name):
-    previous_check = get_previous_check()
-    if previous_check is None:
+    timestamp = get_latest_check_timestamp()
+    if timestamp is None:
         return render_template("error.html", status=500, message="Failed to find last check in database")
 
     package = None
-    for i in previous_check.packages:
-        if i.package == name:
-            package = dict(name=i.package,
-                           version=i.version,
-                           origin=dict(file=i.file, line=i.line))
-            if i.found_upstream:
-                package["upstream_version"] = i.upstream_version
-                package["upstream_repo"] = i.upstream_repo
-            # TODO: do we save this in the database?
-            #       at the moment we dont to save space, as the encoding isnt that great,
-            #       however depending on what the performance of this is ends up being, we might want to consider saving this
-            # Check if package is up to date
-            if i.found_upstream:
-                package["is_up_to_date"] = True if libversion.version_compare2(i.version,
-                                                                               i.upstream_version) >= 0 else False
+    i = get_previous_check_package(timestamp, name)
+    if i is not None:
+        package = package_to_dict(i)
 
     if package is None:
         return render_template("error.html", status=500, message="Failed to find last status of package in the database")
@@ -282,14 +441,37 @@ def package_info_page(name):
                                status=extended_package_data["status"],
                                message=extended_package_data["message"])
 
+    with closing(get_database().cursor()) as c:
+        history = load_package_history(c, name)
+        out_of_date_periods = get_out_of_date_periods(history, get_latest_snapshot_timestamp(c))
+
     return render_template("package-info-page.html",
                            package=package,
-                           extended_package_data=extended_package_data)
+                           extended_package_data=extended_package_data,
+                           history=history,
+                           out_of_date_periods=out_of_date_periods)
 
 
 @app.route("/latest-report.pdf")
 def download_latest_report():
-    return send_from_directory(".", "latest-report.pdf")
+    return send_latest_report("pdf")
+
+
+# The same report in the other formats generated by main.py
+@app.route("/latest-report.<any(html, json, csv):report_format>")
+def download_latest_report_format(report_format):
+    return send_latest_report(report_format)
+
+
+def send_latest_report(report_format: str):
+    with closing(get_database().cursor()) as c:
+        artifact = get_latest_report_artifact(c, report_format)
+    if artifact is None:
+        return render_template("error.html", status=404, message="No report has been generated yet"), 404
+    report_hash, file = artifact
+    # Stored reports never change, so their hash is a strong ETag. Also handles range requests.
+    return send_file(os.path.abspath(file), conditional=True, etag=report_hash,
+                     download_name="latest-report.{}".format(report_format))
 
 
 ### Core API
@@ -300,36 +482,91 @@ def api_doc():
 
 @app.route("/api/packages/list")
 def get_package_list():
-    return_object: dict = dict()
-
-    previous_check = get_previous_check()
-    if previous_check is None:
-        return_object["status"] = 500
-        return_object["message"] = "Failed to find last check in database"
-        return jsonify(return_object)
-
-    name_list: [] = []
-    for package in previous_check.packages:
-        package_dict: dict = dict(name=package.package,
-                                  version=package.version,
-                                  origin=dict(file=package.file, line=package.line))
-        if package.found_upstream:
-            package_dict["upstream_version"] = package.upstream_version
-            package_dict["upstream_repo"] = package.upstream_repo
-        # TODO: do we save this in the database?
-        #       at the moment we dont to save space, as the encoding isnt that great,
-        #       however depending on what the performance of this is ends up being, we might want to consider saving this
-        # Check if package is up to date
-        if package.found_upstream:
-            package_dict["is_up_to_date"] = True if libversion.version_compare2(package.version,
-                                                                                package.upstream_version) >= 0 else False
-        name_list.append(package_dict)
-
-    return_object["status"] = 200
-    return_object["count"] = len(name_list)
-    return_object["packages"] = name_list
-
-    return jsonify(return_object)
+    # Without any parameters, the full list prebuilt for the check is sent
+    if len(request.args):
+        return jsonify(query_package_list(tuple(sorted(request.args.items()))))
+
+    timestamp, path = get_published_file("packages.json")
+    if path is None:
+        return jsonify(dict(status=500, message="Failed to find last check in database"))
+    return send_published_file(path, "application/json", "{}-packages".format(timestamp))
+
+
+# Fields of the package list that can be selected with the fields parameter
+PACKAGE_LIST_FIELDS = ["name", "version", "origin", "upstream_version", "upstream_repo", "is_up_to_date"]
+
+
+# Evaluate the parameters of /api/packages/list against the latest snapshot
+@cached_per_check
+def query_package_list(arguments: tuple) -> dict:
+    arguments = dict(arguments)
+    timestamp = get_latest_check_timestamp()
+    if timestamp is None:
+        return dict(status=500, message="Failed to find last check in database")
+
+    out_of_date: bool | None = None
+    if "out_of_date" in arguments:
+        if arguments["out_of_date"] not in ["0", "1"]:
+            return dict(status=400, message="<out_of_date> must be 0 or 1")
+        out_of_date = arguments["out_of_date"] == "1"
+
+    names: list[str] | None = None
+    if "maintainer" in arguments:
+        # The maintainers are only known by the xbdistro database
+        with closing(get_xbdistro_database().cursor()) as c:
+            c.execute("SELECT name FROM packages WHERE maintainer = ?", [arguments["maintainer"]])
+            names = [row[0] for row in c.fetchall()]
+
+    sort = arguments.get("sort", "name")
+    descending = sort.startswith("-")
+    sort = sort.removeprefix("-")
+    if sort not in SNAPSHOT_SORT_COLUMNS:
+        return dict(status=400, message="<sort> must be one of {}, optionally prefixed with -"
+                    .format(", ".join(SNAPSHOT_SORT_COLUMNS)))
+
+    limit: int | None = None
+    if "limit" in arguments:
+        if not arguments["limit"].isdigit() or not 0 < int(arguments["limit"]) <= package_list_max_limit:
+            return dict(status=400, message="<limit> must be between 1 and {}".format(package_list_max_limit))
+        limit = int(arguments["limit"])
+
+    # The cursor is the sort value and name of the last package of the previous page
+    after: list | None = None
+    if "cursor" in arguments:
+        try:
+            after = json.loads(base64.urlsafe_b64decode(arguments["cursor"]))
+        except ValueError:
+            return dict(status=400, message="Invalid <cursor>")
+        if not isinstance(after, list) or len(after) != 2 or not all(isinstance(i, str) for i in after):
+            return dict(status=400, message="Invalid <cursor>")
+
+    fields = PACKAGE_LIST_FIELDS
+    if "fields" in arguments:
+        fields = arguments["fields"].split(",")
+        if not all(field in PACKAGE_LIST_FIELDS for field in fields):
+            return dict(status=400, message="<fields> must be a list of {}".format(", ".join(PACKAGE_LIST_FIELDS)))
+
+    with closing(get_database().cursor()) as c:
+        # Get one more than requested, to know if there is another page
+        packages = query_snapshot_packages(c, timestamp, out_of_date=out_of_date, repo=arguments.get("repo"),
+                                           names=names, prefix=arguments.get("prefix"), sort=sort,
+                                           descending=descending, after=after,
+                                           limit=limit + 1 if limit is not None else None)
+
+    result: dict = dict(status=200)
+    if limit is not None and len(packages) > limit:
+        packages = packages[:limit]
+        last = packages[-1]
+        sort_value = getattr(last, SNAPSHOT_SORT_COLUMNS[sort]) or ""
+        result["next_cursor"] = base64.urlsafe_b64encode(json.dumps([sort_value, last.package]).encode()).decode()
+
+    package_list: [dict] = []
+    for package in packages:
+        package_dict = package_to_dict(package)
+        package_list.append({field: package_dict[field] for field in fields if field in package_dict})
+    result["count"] = len(package_list)
+    result["packages"] = package_list
+    return result
 
 
 @app.route("/api/packages/package")
@@ -339,12 +576,30 @@ def get_more_package_info():
     return jsonify(get_extended_package_data(request.args["name"]))
 
 
+@app.route("/api/packages/bulk")
+def get_bulk_package_info():
+    if "names" not in request.args:
+        return jsonify(dict(status=300, message="No <names> argument"))
+    names = [name for name in request.args["names"].split(",") if name]
+    return jsonify(dict(status=200, packages=get_extended_package_data_bulk(names)))
+
+
+@app.route("/api/packages/<name>/history")
+def get_package_history(name):
+    with closing(get_database().cursor()) as c:
+        history = load_package_history(c, name)
+        if not len(history):
+            return jsonify(dict(status=404, message="No history found for package '{}'".format(name)))
+        out_of_date_periods = get_out_of_date_periods(history, get_latest_snapshot_timestamp(c))
+
+    return jsonify(dict(status=200, name=name, history=history, out_of_date_periods=out_of_date_periods))
+
+
 @app.route("/api/checks/history")
 def get_check_history():
     return_object: dict = dict(status=200, checks=[])
 
-    with closing(database.cursor()) as c:
-        # Not locked - Cannot issue writes
+    with closing(get_database().cursor()) as c:
         c.execute("SELECT amount_ood, amount, unix_timestamp FROM check_metadata ORDER BY unix_timestamp DESC")
         sql_data = c.fetchall()
         for check in sql_data:
@@ -355,6 +610,14 @@ def get_check_history():
     return jsonify(return_object)
 
 
+@app.route("/api/cache/stats")
+def get_cache_stats():
+    with cache_stats_lock:
+        stats = dict(cache_stats)
+    return jsonify(dict(status=200, latest_check=get_latest_check_timestamp(),
+                        cached_check=previous_check_timestamp, **stats))
+
+
 ### e-mail handling
 @app.route("/email")
 def email_page():
@@ -374,8 +637,7 @@ def begin_unsubscribe_email():
     email = request.args["email"]
 
     code = None
-    with closing(database.cursor()) as c:
-        # Not locked - Cannot issue writes
+    with closing(get_database().cursor()) as c:
         # Check if we are even subscribed
         c.execute("SELECT email from generic_email_recipients WHERE email = ?", [email])
         if c.fetchall() is None:
@@ -390,10 +652,9 @@ def begin_unsubscribe_email():
     if code is None:
         # Generate a code and store it
         code = generate_code()
-        with database_write_lock:
-            with closing(database.cursor()) as c:
-                c.execute("INSERT INTO generic_email_unsubscribe_key(code, email) VALUES(?, ?)", [code, email])
-                database.commit()
+        with closing(get_database().cursor()) as c:
+            c.execute("INSERT INTO generic_email_unsubscribe_key(code, email) VALUES(?, ?)", [code, email])
+            get_database().commit()
 
     # Send a email with the confirmation link
     send_text_email(email,
@@ -413,18 +674,16 @@ def confirm_unsubscribe_email():
     code = request.args["code"]
 
     # Check if the code exists
-    with closing(database.cursor()) as c:
-        # Not locked - Cannot issue writes
+    with closing(get_database().cursor()) as c:
         c.execute("SELECT email FROM generic_email_unsubscribe_key WHERE code = ?", [code])
         email = c.fetchone()
         if email is None:
             return "<p>Invalid URL!<br>If this error persists, please contact mailto:{}</p>".format(contact_email)
         email = email[0]
-    with database_write_lock:
-        with closing(database.cursor()) as c:
-            c.execute("DELETE FROM generic_email_recipients WHERE email = ?", [email])
-            c.execute("DELETE FROM generic_email_unsubscribe_key WHERE code = ? OR email = ?", [code, email])
-            database.commit()
+    with closing(get_database().cursor()) as c:
+        c.execute("DELETE FROM generic_email_recipients WHERE email = ?", [email])
+        c.execute("DELETE FROM generic_email_unsubscribe_key WHERE code = ? OR email = ?", [code, email])
+        get_database().commit()
     send_text_email(email, "This message is to confirm that you have been unsubscribed from regular package report"
                            "emails. No further action is required from your end.", "Unsubscribe Confirmation")
     return "<p>You ({}) have been unsubscribed from regular package update emails.</p>".format(email)
@@ -441,8 +700,7 @@ def begin_email_subscribe():
     code = None
     # Check if an email subscription is already in progress
     # If it is, reuse the code so that all generated links are the same
-    with closing(database.cursor()) as c:
-        # Not locked - Cannot issue writes
+    with closing(get_database().cursor()) as c:
         c.execute("SELECT code FROM generic_email_subscribe_key WHERE email = ?", [email])
         code_check = c.fetchone()
         if code_check is not None:
@@ -451,10 +709,9 @@ def begin_email_subscribe():
     if code is None:
         # Generate a code and store it
         code = generate_code()
-        with database_write_lock:
-            with closing(database.cursor()) as c:
-                c.execute("INSERT INTO generic_email_subscribe_key(code, email) VALUES(?, ?)", [code, email])
-                database.commit()
+        with closing(get_database().cursor()) as c:
+            c.execute("INSERT INTO generic_email_subscribe_key(code, email) VALUES(?, ?)", [code, email])
+            get_database().commit()
 
     # Send a email with the confirmation link
     send_text_email(email,
@@ -474,19 +731,17 @@ def confirm_email_subscribe():
     code = request.args["code"]
 
     # Check if the code exists
-    with closing(database.cursor()) as c:
-        # Not locked - Cannot issue writes
+    with closing(get_database().cursor()) as c:
         c.execute("SELECT email FROM generic_email_subscribe_key WHERE code = ?", [code])
         email = c.fetchone()
         if email is None:
             return "<p>Invalid URL!<br>If this error persists, please contact mailto:{}</p>".format(contact_email)
         email = email[0]
 
-    with database_write_lock:
-        with closing(database.cursor()) as c:
-            c.execute("INSERT INTO generic_email_recipients(email) VALUES(?)", [email])
-            c.execute("DELETE FROM generic_email_subscribe_key WHERE code = ? OR email = ?", [code, email])
-            database.commit()
+    with closing(get_database().cursor()) as c:
+        c.execute("INSERT INTO generic_email_recipients(email) VALUES(?)", [email])
+        c.execute("DELETE FROM generic_email_subscribe_key WHERE code = ? OR email = ?", [code, email])
+        get_database().commit()
     send_text_email(email, "This message is to confirm that you have been subscribed to regular package report"
                            "emails. No further action is required from your end.", "Subscription Confirmation")
     return "<p>You ({}) have been subscribed to regular package update emails.</p>".format(email)